@@ -1,5 +1,7 @@
 # app/config.py
 
+from pathlib import Path
+from typing import Dict, List, Literal
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -7,4 +9,127 @@ class Settings(BaseSettings):
     MAX_CACHE_SIZE: int = 1000
     CACHE_TTL_SECONDS: int = 3600
 
+    # Ollama client dùng chung (connection pool keep-alive)
+    OLLAMA_BASE_URL: str = "http://localhost:11434"
+    OLLAMA_MAX_CONNECTIONS: int = 32
+    OLLAMA_MAX_KEEPALIVE_CONNECTIONS: int = 16
+    OLLAMA_KEEPALIVE_EXPIRY: float = 120.0
+
+    # Scheduler cho request tới Ollama: giới hạn đồng thời, độ dài hàng đợi, thời gian chờ tối đa (giây)
+    OLLAMA_MAX_CONCURRENCY: int = 4
+    OLLAMA_INTERACTIVE_LIMIT: int = 2
+    OLLAMA_EMBEDDING_LIMIT: int = 4
+    OLLAMA_BACKGROUND_LIMIT: int = 1
+    OLLAMA_INTERACTIVE_MAX_QUEUE: int = 16
+    OLLAMA_EMBEDDING_MAX_QUEUE: int = 64
+    OLLAMA_BACKGROUND_MAX_QUEUE: int = 16
+    OLLAMA_INTERACTIVE_MAX_WAIT: float = 30.0
+    OLLAMA_EMBEDDING_MAX_WAIT: float = 10.0
+    OLLAMA_BACKGROUND_MAX_WAIT: float = 60.0
+    OLLAMA_AFFINITY_MAX_SKIP_WAIT: float = 2.0  # Thời gian tối đa một tác vụ phụ bị vượt lượt để gom theo model
+
+    # Model đang load trên Ollama: keep_alive theo model, model thay thế tương thích khi model gốc chưa warm
+    OLLAMA_PS_REFRESH_SECONDS: float = 15.0
+    MODEL_KEEP_ALIVE: Dict[str, str] = {
+        "4T": "30m",
+        "4T-R": "10m",
+        "4T-V": "5m",
+        "4T-S": "5m",
+        "gemma3:12b-it-q4_K_M": "5m",
+        "embeddinggemma:latest": "30m",
+    }
+    MODEL_WARM_ALTERNATIVES: Dict[str, List[str]] = {
+        "gemma3:12b-it-q4_K_M": ["4T"],  # Rewrite query
+        "4T-S": ["4T"],  # Tóm tắt
+    }
+
+    # Model có trên Ollama (/api/tags): fallback khi model không tồn tại, model warm-up lúc khởi động
+    EMBEDDING_MODEL: str = "embeddinggemma:latest"
+    # Cắt Matryoshka embedding còn N chiều đầu + chuẩn hóa lại (512/256/128), 0 để giữ đủ chiều
+    EMBED_TRUNCATE_DIM: int = 0
+    OLLAMA_TAGS_REFRESH_SECONDS: float = 300.0
+    MODEL_FALLBACKS: Dict[str, List[str]] = {
+        "4T-R": ["4T"],
+        "gemma3:12b-it-q4_K_M": ["4T"],
+        "4T-S": ["4T"],
+    }
+    MODEL_WARMUP: List[str] = ["4T", "embeddinggemma:latest"]
+
+    # Nén web_context: chỉ giữ đoạn liên quan nhất (BM25) của mỗi nguồn
+    WEB_CONTEXT_SOURCE_TOKENS: int = 600
+    WEB_PASSAGE_MAX_CHARS: int = 400
+
+    # Chu kỳ kiểm tra client còn kết nối trong lúc stream /api/chat (giây)
+    CHAT_DISCONNECT_POLL_SECONDS: float = 0.5
+
+    # Memory theo từng conversation
+    MEMORY_DIM: int = 768  # Chỉ dùng khi không đo được số chiều embedding lúc khởi động
+    MEMORY_MAX_SHORT: int = 20
+    MEMORY_MAX_CONVERSATIONS: int = 256
+    MEMORY_MAX_RESIDENT_VECTORS: int = 200_000
+    # Lưu memory xuống đĩa (snapshot FAISS + WAL), để trống để chỉ giữ trong RAM
+    MEMORY_DIR: str = str(Path(__file__).resolve().parent.parent / "data" / "memory")
+    MEMORY_SNAPSHOT_EVERY: int = 256  # Số vector trong WAL trước khi ghi snapshot mới
+    MEMORY_RETENTION_DAYS: int = 90  # Xóa memory trên đĩa của conversation không dùng quá số ngày này, 0 = giữ mãi
+    MEMORY_EMBED_BATCH_SIZE: int = 32  # Số message tối đa mỗi request /api/embed của memory writer
+    MEMORY_DUPLICATE_SIMILARITY: float = 0.97  # Cosine để gộp message lặp lại vào hit counter thay vì thêm vector
+    MEMORY_DUPLICATE_CANDIDATES: int = 4  # Số láng giềng gần nhất xét khi tìm message trùng
+    # Index memory tự chuyển Flat -> HNSW -> IVF-PQ (train nền) khi số vector vượt ngưỡng
+    MEMORY_HNSW_THRESHOLD: int = 50_000
+    MEMORY_IVFPQ_THRESHOLD: int = 500_000
+    MEMORY_HNSW_M: int = 32
+    MEMORY_HNSW_EF_CONSTRUCTION: int = 80
+    MEMORY_HNSW_EF_SEARCH: int = 64
+    MEMORY_IVF_NPROBE: int = 16
+    MEMORY_ANN_REFINE: int = 16  # Lấy k * REFINE ứng viên rồi xếp lại bằng khoảng cách chính xác
+    # Tóm tắt nền memory dài hạn: BLOCK message -> summary tầng 1, FANOUT summary tầng L -> tầng L + 1
+    MEMORY_SUMMARY_BLOCK: int = 16
+    MEMORY_SUMMARY_FANOUT: int = 4
+    MEMORY_SUMMARY_MAX_LEVEL: int = 3
+    MEMORY_SUMMARY_PRUNE_RAW: bool = False  # True: retrieve bỏ hẳn message gốc đã được tóm tắt
+    # Retrieve gộp vector + BM25 bằng reciprocal-rank fusion, ưu tiên memory gần đây
+    MEMORY_RRF_K: int = 60
+    MEMORY_RECENCY_WEIGHT: float = 0.3  # 0: không xét thời gian; 1: điểm giảm hẳn theo tuổi memory
+    MEMORY_RECENCY_HALF_LIFE_HOURS: float = 72.0
+
+    # Tiền xử lý ảnh trước khi gửi model vision (4T-V)
+    IMAGE_MAX_UPLOAD_BYTES: int = 20 * 1024 * 1024
+    IMAGE_MAX_SIDE: int = 896  # Độ phân giải đầu vào của vision encoder
+    IMAGE_JPEG_QUALITY: int = 90
+    IMAGE_PREPROCESS_WORKERS: int = 2
+
+    # Cache mô tả ảnh theo perceptual hash (dHash 16x16 = 256 bit)
+    IMAGE_CACHE_MAX_ENTRIES: int = 128
+    IMAGE_CACHE_TTL_SECONDS: float = 3600.0
+    IMAGE_CACHE_MAX_DISTANCE: int = 8  # Số bit (trên 256) khác nhau tối đa để coi là cùng ảnh
+    # Xác nhận thêm bằng ảnh xám 256x256: chênh lệch pixel tối đa (encode lại ~7, đổi một ký tự chữ ~30)
+    IMAGE_CACHE_MAX_PIXEL_DIFF: int = 16
+
+    # Response cache theo ngữ nghĩa (opt-in): prompt chuẩn hóa + embedding lượng tử hóa int8
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_MAX_ENTRIES: int = 512
+    RESPONSE_CACHE_TTL_SECONDS: float = 1800.0
+    RESPONSE_CACHE_SIMILARITY: float = 0.95  # Cosine tối thiểu để coi hai prompt là một
+
+    # Cache embedding theo hash (model, text): LRU trong RAM + SQLite trên đĩa (để trống path để tắt), float16
+    EMBED_CACHE_MAX_ENTRIES: int = 8192
+    EMBED_CACHE_PATH: str = str(Path(__file__).resolve().parent.parent / "data" / "embed_cache.sqlite3")
+    EMBED_CACHE_DISK_MAX_ENTRIES: int = 200_000
+    # Gom các lời gọi embed_text đồng thời thành một request /api/embed
+    EMBED_BATCH_WINDOW_MS: float = 5.0
+    EMBED_BATCH_MAX_SIZE: int = 64
+
+    # Layout context gửi LLM: "stable" giữ prefix cố định để Ollama dùng lại KV cache, "legacy" là layout cũ
+    CONTEXT_LAYOUT: Literal["stable", "legacy"] = "stable"
+    CONTEXT_MAX_MESSAGES: int = 10
+    CONTEXT_HISTORY_BLOCK: int = 6  # Số message mỗi lần dịch cửa sổ history (nên là số chẵn)
+
+    # Ngân sách token của context: num_ctx gửi kèm request (mọi request cùng model phải giống nhau,
+    # nếu không Ollama sẽ load lại model), phần dành cho câu trả lời, memory truy xuất, reply cũ dài
+    MODEL_NUM_CTX: Dict[str, int] = {"4T": 8192, "4T-R": 8192}
+    OLLAMA_DEFAULT_NUM_CTX: int = 4096  # num_ctx mặc định của Ollama cho model không cấu hình
+    CONTEXT_RESPONSE_RESERVE: int = 2048
+    CONTEXT_MEMORY_TOKENS: int = 512
+    CONTEXT_MAX_REPLY_TOKENS: int = 400
+
 settings = Settings()
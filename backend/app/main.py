@@ -1,10 +1,44 @@
 # app/main.py
 
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routes import chat
 from app.routes import search
+from app.routes import metrics
+from app.services.ollama_client import OllamaClient
+from app.services.model_residency import model_residency
+from app.services.model_registry import model_registry
+from app.services.memory_registry import memory_registry
+from app.services.memory_writer import memory_writer
+from app.services.memory_compactor import memory_compactor
+from app.services.session_manager import SessionManager
+from app.services.embedding_cache import embedding_cache
 
-app = FastAPI(title="Web Search Chatbot")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Mở các client dùng chung khi khởi động, đóng khi tắt server."""
+    await OllamaClient.start()
+    model_residency.start()
+    await model_registry.start()
+    await memory_registry.detect_dim()
+    await asyncio.to_thread(memory_registry.cleanup)
+    memory_writer.start()
+    memory_compactor.start()
+    try:
+        yield
+    finally:
+        await memory_compactor.stop()
+        await memory_writer.stop()  # Embed + ghi nốt message đang chờ trước khi snapshot và đóng client
+        await memory_registry.flush()
+        await embedding_cache.close()  # Ghi nốt embedding mới vào SQLite
+        await model_registry.stop()
+        await model_residency.stop()
+        await OllamaClient.close()
+        await SessionManager.close_session()
+
+app = FastAPI(title="Web Search Chatbot", lifespan=lifespan)
 
 app.include_router(chat.router)
 app.include_router(search.router)
+app.include_router(metrics.router)
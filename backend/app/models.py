@@ -5,3 +5,5 @@ from typing import Optional
 class ChatRequest(BaseModel):
     prompt: str
     image: Optional[str] = None  # Thêm field image base64
+    is_thinking: bool = False
+    conversation_id: str = "default"  # Mỗi conversation có memory riêng
@@ -0,0 +1,10 @@
+# app/routes/metrics.py
+
+from fastapi import APIRouter
+from app.utils.metrics import metrics
+
+router = APIRouter(prefix="/api")
+
+@router.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
@@ -0,0 +1,87 @@
+# app/services/embedding_batcher.py
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app.services.ollama_client import OllamaClient
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+
+class EmbeddingBatcher:
+    """Gom các lời gọi embed đồng thời thành một request /api/embed (input dạng list).
+
+    Khi đang có batch chờ Ollama, text đầu tiên mở một cửa sổ `window_ms`; batch được gửi khi hết
+    cửa sổ hoặc đủ `max_batch` text, kết quả trả về từng caller qua future. Khi rảnh thì gửi ngay ở
+    vòng event loop kế tiếp (vẫn gom được các lời gọi trong cùng asyncio.gather) để lời gọi đơn lẻ
+    không phải chờ thêm. Text trùng trong cùng batch chỉ embed một lần.
+    Các batch gửi song song, số request thực tế tới Ollama do scheduler (Priority.EMBEDDING) giới hạn.
+    """
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.requests = 0
+        self.items = 0
+        self.failed = 0
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """Vector của `text` (float32), None nếu request lỗi."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            delay = self.window_ms / 1000 if self._tasks else 0
+            self._timer = loop.call_later(delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        vectors: Dict[str, Optional[np.ndarray]] = {}
+        try:
+            payload = {"model": settings.EMBEDDING_MODEL, "input": texts}
+            data = await OllamaClient.post("/api/embed", payload)
+            embeddings = data["embeddings"]
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Nhận {len(embeddings)} embedding cho {len(texts)} text")
+            vectors = {text: np.array(embedding, dtype="float32") for text, embedding in zip(texts, embeddings)}
+        except Exception as e:
+            self.failed += len(texts)
+            logger.error(f"Lỗi embed batch {len(texts)} text: {e}")
+        finally:
+            self.requests += 1
+            self.items += len(texts)
+            for text, future in batch:
+                if not future.done():  # Caller có thể đã bị hủy
+                    vector = vectors.get(text)
+                    future.set_result(vector.copy() if vector is not None else None)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "items": self.items,
+            "failed": self.failed,
+            "avg_batch": round(self.items / self.requests, 2) if self.requests else 0.0,
+        }
+
+
+# Khởi tạo singleton instance
+embedding_batcher = EmbeddingBatcher(window_ms=settings.EMBED_BATCH_WINDOW_MS, max_batch=settings.EMBED_BATCH_MAX_SIZE)
+metrics.register("embedding_batcher", embedding_batcher.stats)
@@ -0,0 +1,199 @@
+# app/services/embedding_cache.py
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+
+def embedding_key(model: str, text: str) -> bytes:
+    """Khóa cache: hash của (model, text)."""
+    return hashlib.blake2b(f"{model}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """Cache embedding theo hash nội dung: LRU trong RAM + tầng SQLite trên đĩa (tùy chọn).
+
+    Vector lưu float16 (một nửa bộ nhớ, sai số cosine ~1e-3), trả ra bản copy float32 để caller
+    sửa tùy ý. Tầng đĩa giữ embedding qua các lần khởi động lại; khi vượt `disk_max_entries`
+    xóa các entry dùng lâu nhất. Hit trong RAM không rời event loop; đọc SQLite chạy trong thread,
+    ghi (entry mới, cập nhật thời điểm dùng) gom lại cho một task nền ghi sau. Số dòng trên đĩa
+    đếm trong bộ nhớ từ rowcount. Lỗi SQLite chỉ tắt tầng đĩa, không làm hỏng request embed.
+    """
+
+    def __init__(self, max_entries: int, path: str = "", disk_max_entries: int = 0):
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+        self._entries: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()  # Thread đọc và task ghi nền dùng chung một connection
+        self._disk_entries = 0
+        self._writes: Dict[bytes, Optional[bytes]] = {}  # Chờ ghi: vector mới, None = chỉ cập nhật `used`
+        self._writer: Optional[asyncio.Task] = None
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Mở file SQLite ở lần dùng đầu (import module không tạo file). Gọi trong thread, giữ `_db_lock`."""
+        if self._db is None and self.path:
+            try:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=OFF")  # Mất vài entry khi crash không sao, chỉ là cache
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings "
+                    "(key BLOB PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings(used)")
+                self._disk_entries = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                self._db = db
+            except sqlite3.Error as e:
+                logger.warning(f"Tắt cache embedding trên đĩa ({self.path}): {e}")
+                self.path = ""
+        return self._db
+
+    def _disk_error(self, e: sqlite3.Error):
+        logger.warning(f"Tắt cache embedding trên đĩa ({self.path}): {e}")
+        self.path = ""
+        self._db = None
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        """Đọc vector (float16 bytes) của các key có trên đĩa (chạy trong thread)."""
+        found: Dict[bytes, bytes] = {}
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return found
+            try:
+                for key in keys:
+                    row = db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        found[key] = row[0]
+            except sqlite3.Error as e:
+                self._disk_error(e)
+        return found
+
+    async def get(self, key: bytes) -> Optional[np.ndarray]:
+        return (await self.get_many([key]))[0]
+
+    async def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        """Vector float32 theo thứ tự `keys` (None nếu không có); các key không có trong RAM đọc đĩa một lượt."""
+        vectors: List[Optional[np.ndarray]] = [None] * len(keys)
+        missing: List[int] = []
+        for i, key in enumerate(keys):
+            vector = self._entries.get(key)
+            if vector is None:
+                missing.append(i)
+                continue
+            self._entries.move_to_end(key)
+            self.hits += 1
+            vectors[i] = vector.astype(np.float32)
+        if missing and self.path:
+            missing_keys = [keys[i] for i in missing]
+            # Entry mới chờ ghi mà đã rời RAM vẫn đọc được trước khi task ghi chạy tới
+            found = {key: blob for key in missing_keys if (blob := self._writes.get(key)) is not None}
+            rest = [key for key in missing_keys if key not in found]
+            if rest:
+                found.update(await asyncio.to_thread(self._read, rest))
+            for i in missing:
+                blob = found.get(keys[i])
+                if blob is not None:
+                    vector = np.frombuffer(blob, dtype=np.float16)
+                    self._remember(keys[i], vector)
+                    self._queue(keys[i], None)
+                    self.disk_hits += 1
+                    vectors[i] = vector.astype(np.float32)
+        self.misses += sum(vectors[i] is None for i in missing)
+        return vectors
+
+    def put(self, key: bytes, vector: np.ndarray):
+        stored = np.asarray(vector, dtype=np.float16)
+        self._remember(key, stored)
+        if self.path:
+            self._queue(key, stored.tobytes())
+
+    def _queue(self, key: bytes, blob: Optional[bytes]):
+        if blob is not None or key not in self._writes:
+            self._writes[key] = blob
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_behind())
+
+    async def _write_behind(self):
+        while self._writes:
+            batch, self._writes = self._writes, {}
+            await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch: Dict[bytes, Optional[bytes]]):
+        """Ghi một lô entry mới / cập nhật `used` trong một transaction (chạy trong thread)."""
+        now = time.time()
+        inserts = [(key, blob, now) for key, blob in batch.items() if blob is not None]
+        touches = [(now, key) for key, blob in batch.items() if blob is None]
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                db.execute("BEGIN")
+                db.executemany("UPDATE embeddings SET used = ? WHERE key = ?", touches)
+                inserted = db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, used) VALUES (?, ?, ?)", inserts
+                ).rowcount
+                self._disk_entries += max(inserted, 0)
+                if self._disk_entries > self.disk_max_entries:
+                    # Xóa theo lô (10%) để không phải dọn ở mỗi lần ghi
+                    excess = self._disk_entries - self.disk_max_entries + self.disk_max_entries // 10
+                    deleted = db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)",
+                        (excess,),
+                    ).rowcount
+                    self._disk_entries -= deleted
+                db.execute("COMMIT")
+            except sqlite3.Error as e:
+                if db.in_transaction:
+                    db.rollback()
+                self._disk_error(e)
+
+    async def close(self):
+        """Ghi nốt các entry đang chờ (khi tắt server)."""
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        if self._writes:
+            await self._write_behind()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "disk_entries": self._disk_entries,
+            "pending_writes": len(self._writes),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+
+# Khởi tạo singleton instance
+embedding_cache = EmbeddingCache(
+    max_entries=settings.EMBED_CACHE_MAX_ENTRIES,
+    path=settings.EMBED_CACHE_PATH,
+    disk_max_entries=settings.EMBED_CACHE_DISK_MAX_ENTRIES,
+)
+metrics.register("embedding_cache", embedding_cache.stats)
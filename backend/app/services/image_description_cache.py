@@ -0,0 +1,87 @@
+# app/services/image_description_cache.py
+import itertools
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+
+@dataclass
+class CachedDescription:
+    phash: int
+    fingerprint: np.ndarray
+    description: str
+    events: List[bytes]  # Các event image_processing / image_description đã gửi client
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class ImageDescriptionCache:
+    """Cache mô tả ảnh của model vision theo perceptual hash.
+
+    Ảnh gửi lại (cùng screenshot, encode/resize lại) có hash lệch ít bit nên vẫn khớp khi
+    khoảng cách Hamming <= max_distance. Hash thô không phân biệt được screenshot chỉ khác vài
+    dòng chữ, nên ứng viên còn phải có ảnh xám fingerprint lệch không quá max_pixel_diff.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, max_distance: int, max_pixel_diff: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.max_pixel_diff = max_pixel_diff
+        # Key là id tăng dần: hai ảnh khác nội dung có thể trùng hash
+        self._entries: "OrderedDict[int, CachedDescription]" = OrderedDict()
+        self._ids = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0  # Hash khớp nhưng fingerprint khác (ảnh khác nội dung)
+
+    def _same_image(self, entry: CachedDescription, fingerprint: np.ndarray) -> bool:
+        if entry.fingerprint.shape != fingerprint.shape:
+            return False
+        diff = np.abs(entry.fingerprint.astype(np.int16) - fingerprint.astype(np.int16))
+        return int(diff.max()) <= self.max_pixel_diff
+
+    def lookup(self, phash: int, fingerprint: np.ndarray) -> Optional[CachedDescription]:
+        now = time.monotonic()
+        best_key, best_distance = None, self.max_distance + 1
+        for key, entry in list(self._entries.items()):
+            if now - entry.created_at > self.ttl_seconds:
+                del self._entries[key]
+                continue
+            distance = (entry.phash ^ phash).bit_count()
+            if distance < best_distance:
+                if self._same_image(entry, fingerprint):
+                    best_key, best_distance = key, distance
+                else:
+                    self.rejected += 1
+        if best_key is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(best_key)
+        self.hits += 1
+        logger.info(f"Cache mô tả ảnh hit (Hamming={best_distance})")
+        return self._entries[best_key]
+
+    def store(self, phash: int, fingerprint: np.ndarray, description: str, events: List[bytes]):
+        self._entries[next(self._ids)] = CachedDescription(phash, fingerprint, description, list(events))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "rejected": self.rejected}
+
+
+# Khởi tạo singleton instance
+image_description_cache = ImageDescriptionCache(
+    max_entries=settings.IMAGE_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.IMAGE_CACHE_TTL_SECONDS,
+    max_distance=settings.IMAGE_CACHE_MAX_DISTANCE,
+    max_pixel_diff=settings.IMAGE_CACHE_MAX_PIXEL_DIFF,
+)
+metrics.register("image_description_cache", image_description_cache.stats)
@@ -7,10 +7,9 @@ from typing import Optional, Set, List
 import httpx
 from app.utils.logger import logger
 from app.services.get_time import get_current_time_info
-from app.services.session_manager import SessionManager
-from app.services.memory_manager import HybridMemory
+from app.services.model_residency import model_residency
+from app.services.model_registry import model_registry
 
-OLLAMA_API_URL = "http://localhost:11434/api/chat"
 model_check = "gemma3:12b-it-q4_K_M"  # Fallback sang model chính nếu 4T-Base không tồn tại
 
 # Từ khóa cho tìm kiếm web
@@ -51,14 +50,37 @@ THINKING_TRIGGER_KEYWORDS = {
     'code', 'mã', 'program', 'programming', 'reasoning', 'thinking', 'analyze'
 }
 
+# Từ khóa cho câu hỏi cần dữ liệu mới (không được trả lời từ response cache)
+TIME_SENSITIVE_KEYWORDS = {
+    'tin tức', 'news', 'mới nhất', 'latest', 'thời sự',
+    'giá', 'price', 'tỷ giá', 'exchange rate',
+    'hiện tại', 'bây giờ', 'now', 'current', 'hôm nay', 'today',
+    'hôm qua', 'yesterday', 'ngày mai', 'tomorrow', 'tuần này', 'this week',
+    'mấy giờ', 'ngày mấy', 'update', 'cập nhật', 'gần đây', 'recent',
+    'thị trường', 'market', 'stock', 'chứng khoán', 'cryptocurrency', 'crypto',
+    'weather', 'thời tiết', 'forecast', 'dự báo', 'trending', 'xu hướng'
+}
+
+# Từ chỉ ngữ cảnh hội thoại (đại từ, "tiếp tục", "ở trên", thông tin về chính user): câu trả lời phụ thuộc
+# history/memory của conversation nên không dùng chung response cache giữa các conversation
+CONTEXT_REFERENCE_RE = re.compile(
+    r'\b(nó|đó|đấy|này|kia|ấy|trên|dưới|tiếp|tiếp tục|vừa rồi|vừa nãy|lúc nãy|hồi nãy|như vậy|thế còn|còn|'
+    r'tôi|mình|tớ|tao|của tôi|của mình|'
+    r'it|that|this|these|those|above|previous|again|continue|earlier|i|me|my|mine)\b',
+    re.IGNORECASE,
+)
+
 # Cache cho quyết định
 search_decision_cache: dict = {}
 thinking_decision_cache: dict = {}
 
-# Khởi tạo HybridMemory
-memory = HybridMemory()
+def _recent_user_text(history: Optional[List[dict]]) -> str:
+    """Ghép 2 tin nhắn user gần nhất trong history của conversation."""
+    return " ".join(
+        [msg.get("content", "") for msg in (history or []) if isinstance(msg, dict) and "role" in msg and msg["role"] == "user"][-2:]
+    ).lower()
 
-def _quick_search_check(prompt: str) -> bool:
+def _quick_search_check(prompt: str, history: Optional[List[dict]] = None) -> bool:
     """Kiểm tra nhanh xem prompt có yêu cầu tìm kiếm web hay không."""
     prompt_lower = prompt.lower()
 
@@ -89,15 +111,12 @@ def _quick_search_check(prompt: str) -> bool:
     if re.search(r'\b(ai|bao nhiêu|ở đâu|nơi nào|khi nào|thế nào|làm sao)\b|\?', prompt_lower):
         # Kiểm tra ngữ cảnh lịch sử nếu prompt ngắn
         if len(prompt.split()) < 6:
-            recent_messages = " ".join(
-                [msg.get("content", "") for msg in memory.short_history if isinstance(msg, dict) and "role" in msg and msg["role"] == "user"][-2:]
-            ).lower()
+            # Phụ thuộc history của từng conversation nên không ghi cache
+            recent_messages = _recent_user_text(history)
             if any(kw in recent_messages for kw in SEARCH_KEYWORDS):
-                search_decision_cache[prompt_lower] = True
                 return True
             else:
                 logger.info(f"Bỏ qua tìm kiếm do thiếu ngữ cảnh tìm kiếm: {prompt_lower}")
-                search_decision_cache[prompt_lower] = False
                 return False
         else:
             search_decision_cache[prompt_lower] = True
@@ -107,7 +126,7 @@ def _quick_search_check(prompt: str) -> bool:
     search_decision_cache[prompt_lower] = False
     return False
 
-def _quick_thinking_check(prompt: str) -> bool:
+def _quick_thinking_check(prompt: str, history: Optional[List[dict]] = None) -> bool:
     """Kiểm tra nhanh xem prompt có yêu cầu suy luận sâu hay không."""
     prompt_lower = prompt.lower()
 
@@ -141,25 +160,33 @@ def _quick_thinking_check(prompt: str) -> bool:
 
     # Kiểm tra độ dài và ngữ cảnh lịch sử
     if len(prompt.split()) > 8:
-        recent_messages = " ".join(
-            [msg.get("content", "") for msg in memory.short_history if isinstance(msg, dict) and "role" in msg and msg["role"] == "user"][-2:]
-        ).lower()
+        # Phụ thuộc history của từng conversation nên không ghi cache
+        recent_messages = _recent_user_text(history)
         if any(kw in recent_messages for kw in THINKING_TRIGGER_KEYWORDS):
-            thinking_decision_cache[prompt_lower] = True
             return True
+        return False
 
     # Mặc định không suy luận
     thinking_decision_cache[prompt_lower] = False
     return False
 
-async def should_search_web(prompt: str) -> bool:
-    """Quyết định xem có nên tìm kiếm web dựa trên prompt."""
-    result = _quick_search_check(prompt)
+def is_time_sensitive(prompt: str) -> bool:
+    """Prompt hỏi dữ liệu thay đổi theo thời gian (tin tức, giá, thời tiết...), câu trả lời cũ không dùng lại được."""
+    prompt_lower = prompt.lower()
+    return prompt_lower.startswith("/search") or any(kw in prompt_lower for kw in TIME_SENSITIVE_KEYWORDS)
+
+def is_context_free(prompt: str) -> bool:
+    """Prompt tự đủ nghĩa (chào hỏi, câu hỏi FAQ), không tham chiếu history/memory của conversation."""
+    return not CONTEXT_REFERENCE_RE.search(prompt)
+
+async def should_search_web(prompt: str, history: Optional[List[dict]] = None) -> bool:
+    """Quyết định xem có nên tìm kiếm web dựa trên prompt và history của conversation."""
+    result = _quick_search_check(prompt, history)
     logger.info(f"Quyết định tìm kiếm web: {result} cho prompt: {prompt[:50]}...")
     return result
 
-async def should_thinking(messages_for_llm: List[dict]) -> bool:
-    """Quyết định xem có nên dùng chế độ suy luận dựa trên prompt."""
+async def should_thinking(messages_for_llm: List[dict], history: Optional[List[dict]] = None) -> bool:
+    """Quyết định xem có nên dùng chế độ suy luận dựa trên prompt và history của conversation."""
     # Lấy prompt từ tin nhắn cuối cùng của user
     user_msg = next((msg for msg in reversed(messages_for_llm) if msg["role"] == "user"), None)
     if not user_msg or not isinstance(user_msg, dict) or "content" not in user_msg:
@@ -167,7 +194,7 @@ async def should_thinking(messages_for_llm: List[dict]) -> bool:
         return False
 
     prompt = user_msg["content"]
-    result = _quick_thinking_check(prompt)
+    result = _quick_thinking_check(prompt, history)
     logger.info(f"Quyết định suy luận: {result} cho prompt: {prompt[:50]}...")
     return result
 
@@ -187,25 +214,28 @@ async def generate_search_query(prompt: str) -> str:
         - Output only the search query. NO Title.
     """
 
+    # Chọn model có sẵn (và đang warm nếu được) trước khi gửi request
+    requested_model = model_residency.route(model_check)
+    query_model = model_registry.resolve(requested_model)
+    if query_model is None:
+        return prompt  # Không có model nào để rewrite, dùng query gốc
+
     try:
-        session = await SessionManager.get_session()
         payload = {
-            "model": model_check,
+            "model": query_model,
             "messages": [
                 {"role": "user", "content": _prompt}
             ],
             "stream": False,
             "options": {"num_predict": 500, "temperature": 0.1}
         }
-        async with session.post(OLLAMA_API_URL, json=payload) as response:
-            response.raise_for_status()
-            data = await response.json()
-            query = data['message']['content'].strip()
-            logger.info(f"Truy vấn tìm kiếm được tạo: {query}")
-            return query
+        data = await model_registry.post("/api/chat", payload, requested=requested_model)
+        query = data['message']['content'].strip()
+        logger.info(f"Truy vấn tìm kiếm được tạo: {query}")
+        return query
     except httpx.HTTPStatusError as e:
         if e.response.status_code == 404:
-            logger.warning(f"Model {model_check} không tồn tại (404), fallback query gốc")
+            logger.warning(f"Model {requested_model} và fallback không tồn tại (404), fallback query gốc")
         else:
             logger.error(f"Lỗi HTTP khi tạo truy vấn tìm kiếm: {e}")
         return prompt  # Fallback query gốc nếu lỗi API
@@ -0,0 +1,288 @@
+# app/services/memory_columns.py
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.logger import logger
+
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    if size <= len(array):
+        return array
+    grown = np.empty(max(size, len(array) * 2), dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def encode_line(role: str, content: str, time: datetime, level: int = 0, span: Optional[Tuple[int, int]] = None) -> bytes:
+    """Một dòng JSON của file metadata append-only (summary có thêm level và span id được tóm tắt)."""
+    record = {"role": role, "content": content, "time": time.isoformat()}
+    if level:
+        record["level"] = level
+        record["span"] = list(span)
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class MemoryColumns:
+    """Metadata memory dài hạn dạng cột, phần tử thứ i ứng với vector thứ i của FAISS.
+
+    Role lưu mã uint8, thời gian là datetime64[us], content là đoạn [start, end) trong buffer UTF-8:
+    `bytearray` trong RAM, hoặc chính file JSONL trên đĩa (`path`) và chỉ đọc khi cần (theo id).
+    `hits` đếm số lần message gần trùng được gộp vào entry; mỗi lần gộp ghi thêm id vào `hits_path`.
+    Summary có `level` >= 1 và tóm tắt các entry tầng `level - 1` trong khoảng id [span_start, span_end);
+    `parents` (suy ra từ span) trỏ tới summary trực tiếp của mỗi entry, -1 nếu chưa được tóm tắt.
+    """
+
+    def __init__(self, path: Optional[Path] = None, hits_path: Optional[Path] = None):
+        self.path = path
+        self.hits_path = hits_path
+        self._buffer = bytearray() if path is None else None
+        self._size = 0
+        self._roles = np.empty(16, dtype=np.uint8)
+        self._times = np.empty(16, dtype="datetime64[us]")
+        self._starts = np.empty(16, dtype=np.int64)
+        self._ends = np.empty(16, dtype=np.int64)
+        self._hits = np.empty(16, dtype=np.uint32)
+        self._levels = np.empty(16, dtype=np.uint8)
+        self._span_starts = np.empty(16, dtype=np.int64)
+        self._span_ends = np.empty(16, dtype=np.int64)
+        self._parents = np.empty(16, dtype=np.int64)
+        self.role_names: List[str] = []
+        self._role_codes: Dict[str, int] = {}
+        self._end = 0  # Kích thước dữ liệu hợp lệ (buffer hoặc file)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def data_size(self) -> int:
+        """Số byte hợp lệ của buffer/file content."""
+        return self._end
+
+    @property
+    def roles(self) -> np.ndarray:
+        return self._roles[: self._size]
+
+    @property
+    def times(self) -> np.ndarray:
+        return self._times[: self._size]
+
+    @property
+    def hits(self) -> np.ndarray:
+        return self._hits[: self._size]
+
+    @property
+    def levels(self) -> np.ndarray:
+        return self._levels[: self._size]
+
+    @property
+    def parents(self) -> np.ndarray:
+        return self._parents[: self._size]
+
+    def unsummarized(self, level: int) -> np.ndarray:
+        """Id (tăng dần) các entry tầng `level` chưa có summary."""
+        return np.flatnonzero((self.levels == level) & (self.parents < 0))
+
+    def _link(self, i: int):
+        """Gắn entry con (chưa có summary) trong span của summary `i` vào summary đó."""
+        start, end = int(self._span_starts[i]), int(self._span_ends[i])
+        children = np.flatnonzero(
+            (self._levels[start:end] == self._levels[i] - 1) & (self._parents[start:end] < 0)
+        ) + start
+        self._parents[children] = i
+
+    def add_hit(self, i: int):
+        """Gộp một message gần trùng vào entry `i`."""
+        self._hits[i] += 1
+        if self.hits_path is not None:
+            with open(self.hits_path, "ab") as f:
+                f.write(np.int64(i).tobytes())
+
+    def role_code(self, role: str) -> int:
+        code = self._role_codes.get(role)
+        if code is None:
+            code = len(self.role_names)
+            self.role_names.append(role)
+            self._role_codes[role] = code
+        return code
+
+    def _push(self, role: str, time: datetime, start: int, end: int, level: int = 0, span: Optional[Tuple[int, int]] = None):
+        size = self._size + 1
+        self._roles = _grow(self._roles, size)
+        self._times = _grow(self._times, size)
+        self._starts = _grow(self._starts, size)
+        self._ends = _grow(self._ends, size)
+        self._hits = _grow(self._hits, size)
+        self._levels = _grow(self._levels, size)
+        self._span_starts = _grow(self._span_starts, size)
+        self._span_ends = _grow(self._span_ends, size)
+        self._parents = _grow(self._parents, size)
+        self._roles[self._size] = self.role_code(role)
+        self._times[self._size] = np.datetime64(time, "us")
+        self._starts[self._size] = start
+        self._ends[self._size] = end
+        self._hits[self._size] = 1
+        self._levels[self._size] = level
+        self._span_starts[self._size], self._span_ends[self._size] = span if level else (-1, -1)
+        self._parents[self._size] = -1
+        self._size = size
+        self._end = end
+        if level:
+            self._link(size - 1)
+
+    def append(self, role: str, content: str, time: datetime, level: int = 0, span: Optional[Tuple[int, int]] = None):
+        if self._buffer is not None:
+            data = content.encode("utf-8")
+            self._buffer += data
+        else:
+            data = encode_line(role, content, time, level, span)
+            with open(self.path, "ab") as f:
+                f.write(data)
+        self._push(role, time, self._end, self._end + len(data), level, span)
+
+    def content(self, i: int) -> str:
+        start, end = int(self._starts[i]), int(self._ends[i])
+        if self._buffer is not None:
+            return self._buffer[start:end].decode("utf-8")
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return json.loads(f.read(end - start))["content"]
+
+    def contents(self) -> Iterator[str]:
+        """Content của mọi entry theo thứ tự id (đọc tuần tự một lượt, dùng khi dựng lại index phụ)."""
+        if self._buffer is not None:
+            for start, end in zip(self._starts[: self._size].tolist(), self._ends[: self._size].tolist()):
+                yield self._buffer[start:end].decode("utf-8")
+            return
+        with open(self.path, "rb") as f:
+            for _ in range(self._size):
+                yield json.loads(f.readline())["content"]
+
+    def __getitem__(self, i: int) -> Dict:
+        if i < 0:
+            i += self._size
+        if not 0 <= i < self._size:
+            raise IndexError(i)
+        return {
+            "role": self.role_names[self._roles[i]],
+            "content": self.content(i),
+            "time": self._times[i].astype(datetime),
+            "hits": int(self._hits[i]),
+            "level": int(self._levels[i]),
+        }
+
+    def truncate(self, size: int):
+        """Giữ `size` phần tử đầu (cắt cả file/buffer), dùng khi đối chiếu với FAISS sau crash."""
+        end = int(self._ends[size - 1]) if size else 0
+        self._size = min(self._size, size)
+        self._end = end
+        parents = self._parents[: self._size]
+        parents[parents >= size] = -1  # Summary bị cắt: các entry con lại thành chưa tóm tắt
+        if self._buffer is not None:
+            del self._buffer[end:]
+        elif self.path.exists() and self.path.stat().st_size != end:
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        if self.hits_path is not None and self.hits_path.exists():
+            # Id bị cắt sẽ được dùng lại cho entry mới, bỏ các lần gộp cũ của chúng
+            ids = self._read_hits()
+            tmp = self.hits_path.with_name(self.hits_path.name + ".tmp")
+            ids[ids < size].tofile(tmp)
+            os.replace(tmp, self.hits_path)
+
+    def _read_hits(self) -> np.ndarray:
+        size = self.hits_path.stat().st_size // 8  # Bỏ record ghi dở
+        return np.fromfile(self.hits_path, dtype="<i8", count=size)
+
+    def nbytes(self) -> int:
+        """Bộ nhớ RAM của metadata (không tính content nằm trên đĩa)."""
+        arrays = sum(
+            array.nbytes
+            for array in (
+                self._roles, self._times, self._starts, self._ends, self._hits,
+                self._levels, self._span_starts, self._span_ends, self._parents,
+            )
+        )
+        return arrays + (len(self._buffer) if self._buffer is not None else 0)
+
+    def save_index(self, index_path: Path):
+        """Ghi cột role/time/offset ra file phụ để lần mở sau không phải parse lại toàn bộ JSONL."""
+        tmp = index_path.with_name(index_path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                roles=self.roles,
+                times=self.times.astype(np.int64),
+                starts=self._starts[: self._size],
+                ends=self._ends[: self._size],
+                levels=self.levels,
+                span_starts=self._span_starts[: self._size],
+                span_ends=self._span_ends[: self._size],
+                role_names=np.array(self.role_names, dtype=str),
+            )
+        os.replace(tmp, index_path)
+
+    def _load_index(self, index_path: Path, file_size: int) -> bool:
+        try:
+            with np.load(index_path) as data:
+                ends = data["ends"]
+                if len(ends) and int(ends[-1]) > file_size:
+                    return False  # File metadata bị cắt sau lần ghi index
+                for name in data["role_names"].tolist():
+                    self.role_code(name)
+                size = len(ends)
+                self._roles = data["roles"].astype(np.uint8)
+                self._times = data["times"].astype("datetime64[us]")
+                self._starts = data["starts"].astype(np.int64)
+                self._ends = ends.astype(np.int64)
+                self._hits = np.ones(size, dtype=np.uint32)
+                self._levels = data["levels"].astype(np.uint8)
+                self._span_starts = data["span_starts"].astype(np.int64)
+                self._span_ends = data["span_ends"].astype(np.int64)
+                self._parents = np.full(size, -1, dtype=np.int64)
+                self._size = size
+                self._end = int(ends[-1]) if size else 0
+                for i in np.flatnonzero(self._levels).tolist():
+                    self._link(i)
+                return True
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Bỏ qua index metadata {index_path}: {e}")
+            return False
+
+    @classmethod
+    def open(cls, path: Path, index_path: Path, hits_path: Optional[Path] = None) -> Tuple["MemoryColumns", int]:
+        """Mở metadata trên đĩa: đọc file index phụ rồi chỉ parse các dòng JSONL ghi sau đó.
+
+        Dừng ở dòng hỏng/dở dang (crash khi đang ghi); trả (columns, kích thước file thực tế).
+        """
+        columns = cls(path, hits_path)
+        if not path.exists():
+            return columns, 0
+        file_size = path.stat().st_size
+        if index_path.exists() and not columns._load_index(index_path, file_size):
+            columns = cls(path, hits_path)
+        offset = columns._end
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    item = json.loads(line)
+                    time = datetime.fromisoformat(item["time"])
+                    role = item["role"]
+                    level = int(item.get("level", 0))
+                    span = tuple(item["span"]) if level else None
+                except (json.JSONDecodeError, KeyError, ValueError, TypeError):
+                    break
+                columns._push(role, time, offset, offset + len(line), level, span)
+                offset += len(line)
+        if hits_path is not None and hits_path.exists():
+            ids = columns._read_hits()
+            ids = ids[(ids >= 0) & (ids < columns._size)]
+            columns._hits[: columns._size] += np.bincount(ids, minlength=columns._size).astype(np.uint32)
+        return columns, file_size
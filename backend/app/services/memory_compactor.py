@@ -0,0 +1,112 @@
+# app/services/memory_compactor.py
+import asyncio
+import time
+from typing import TYPE_CHECKING, List, Optional
+
+from app.config import settings
+from app.services.summarize_history import summarize_history
+from app.utils.embed import embed_texts
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from app.services.memory_manager import HybridMemory
+
+
+class MemoryCompactor:
+    """Tóm tắt nền memory dài hạn thành nhiều tầng.
+
+    Mỗi `block_size` message đã rời short-term (tầng 0) chưa có summary được gộp thành một summary
+    tầng 1; mỗi `fanout` summary tầng L gộp tiếp thành một summary tầng L + 1 (tới `max_level`).
+    Summary được embed và thêm vào FAISS như một entry bình thường, retrieve ưu tiên summary hơn
+    message gốc nên context giữ ngắn dù hội thoại dài. Gọi LLM với Priority.BACKGROUND.
+    """
+
+    def __init__(self, block_size: int, fanout: int, max_level: int):
+        self.block_size = block_size
+        self.fanout = fanout
+        self.max_level = max_level
+        self._queue: "asyncio.Queue[HybridMemory]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.summaries = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def notify(self, memory: "HybridMemory"):
+        """Báo memory vừa có thêm entry dài hạn; bỏ qua nếu đã nằm trong queue hoặc chưa đủ một block."""
+        if not self.running or memory.compacting or self._next_block(memory) is None:
+            return
+        memory.compacting = True
+        self._queue.put_nowait(memory)
+
+    def _next_block(self, memory: "HybridMemory"):
+        """(level, id các entry con) của summary tiếp theo cần tạo, tầng thấp trước; None nếu chưa đủ."""
+        for level in range(1, self.max_level + 1):
+            size = self.block_size if level == 1 else self.fanout
+            children = memory.store.unsummarized(level - 1)
+            if len(children) >= size:
+                return level, children[:size]
+        return None
+
+    async def compact(self, memory: "HybridMemory") -> bool:
+        """Tạo một summary cho memory; False nếu không còn block nào hoặc tóm tắt/embed lỗi."""
+        block = self._next_block(memory)
+        if block is None:
+            return False
+        level, ids = block
+        started = time.perf_counter()
+        messages: List[dict] = [memory.store[int(i)] for i in ids]
+        summary = await summarize_history([messages])
+        vec = (await embed_texts([summary]))[0] if summary else None
+        if vec is None:
+            self.failed += 1
+            logger.warning(f"Không tạo được summary tầng {level} cho {len(ids)} memory, thử lại ở lần sau")
+            return False
+        await memory.add_summary(summary, vec, level, (int(ids[0]), int(ids[-1]) + 1))
+        self.summaries += 1
+        metrics.inc("memory_summaries_created")
+        logger.debug(f"Tóm tắt {len(ids)} memory thành summary tầng {level} trong {time.perf_counter() - started:.1f}s")
+        return True
+
+    async def _run(self):
+        while True:
+            memory = await self._queue.get()
+            try:
+                while await self.compact(memory):
+                    pass
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Lỗi tóm tắt memory nền: {e}")
+            finally:
+                memory.compacting = False
+                self._queue.task_done()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="memory-compactor")
+
+    async def stop(self):
+        """Dừng ngay (block chưa tóm tắt sẽ được xử lý ở lần chạy sau, không mất dữ liệu)."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        while not self._queue.empty():
+            self._queue.get_nowait().compacting = False
+            self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "summaries": self.summaries, "failed": self.failed}
+
+
+# Khởi tạo singleton instance
+memory_compactor = MemoryCompactor(
+    block_size=settings.MEMORY_SUMMARY_BLOCK,
+    fanout=settings.MEMORY_SUMMARY_FANOUT,
+    max_level=settings.MEMORY_SUMMARY_MAX_LEVEL,
+)
+metrics.register("memory_compactor", memory_compactor.stats)
@@ -0,0 +1,209 @@
+# app/services/memory_index.py
+import asyncio
+import math
+import time
+from typing import Optional, Tuple
+
+import faiss
+import numpy as np
+
+from app.config import settings
+from app.services.memory_store import MappedIndex, MemoryStore
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+KINDS = ("flat", "hnsw", "ivfpq")
+
+
+def target_kind(ntotal: int) -> str:
+    """Loại index phù hợp với số vector theo ngưỡng cấu hình."""
+    if ntotal >= settings.MEMORY_IVFPQ_THRESHOLD:
+        return "ivfpq"
+    if ntotal >= settings.MEMORY_HNSW_THRESHOLD:
+        return "hnsw"
+    return "flat"
+
+
+def index_kind(index: Optional[faiss.Index]) -> str:
+    if index is None:
+        return "flat"
+    return "hnsw" if isinstance(index, faiss.IndexHNSW) else "ivfpq"
+
+
+def _pq_subquantizers(d: int) -> int:
+    """Số sub-quantizer PQ: mỗi sub-vector khoảng 8 chiều (d phải chia hết)."""
+    for m in range(max(1, d // 8), 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+
+def build_ann(kind: str, vectors: np.ndarray, metric_type: int) -> faiss.Index:
+    """Train + add index xấp xỉ trên toàn bộ vector (chạy trong thread, có thể mất vài phút ở 10^6)."""
+    n, d = vectors.shape
+    rng = np.random.default_rng(0)
+    if kind == "hnsw":
+        # Storage SQ8 (1 byte/chiều) thay vì bản sao float32: vector gốc đã có trong MappedIndex để refine
+        index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_8bit, settings.MEMORY_HNSW_M, metric_type)
+        index.hnsw.efConstruction = settings.MEMORY_HNSW_EF_CONSTRUCTION
+        sample_size = min(n, 100_000)
+    else:
+        nlist = max(1, int(4 * math.sqrt(n)))
+        quantizer = faiss.IndexFlat(d, metric_type)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, _pq_subquantizers(d), 8, metric_type)
+        sample_size = min(n, max(nlist * 39, 256 * 39), 200_000)
+    sample = vectors if sample_size == n else vectors[rng.choice(n, sample_size, replace=False)]
+    index.train(np.ascontiguousarray(sample))
+    index.add(vectors)
+    return index
+
+
+def configure_search(index: faiss.Index):
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = settings.MEMORY_HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = settings.MEMORY_IVF_NPROBE
+
+
+class AdaptiveIndex:
+    """Index memory dài hạn: Flat khi nhỏ, tự chuyển sang HNSW rồi IVF-PQ khi vượt ngưỡng.
+
+    Vector gốc luôn nằm trong `raw` (MappedIndex, nguồn dữ liệu chuẩn được snapshot/WAL). Index xấp xỉ
+    chỉ là lớp tăng tốc: train trong thread nền, bù vector thêm trong lúc train rồi mới swap (một phép
+    gán trên event loop). Ứng viên của index xấp xỉ được xếp lại bằng khoảng cách chính xác từ `raw`.
+    """
+
+    def __init__(self, raw: MappedIndex, persistence: Optional[MemoryStore] = None):
+        self.raw = raw
+        self.persistence = persistence
+        self.ann: Optional[faiss.Index] = None
+        self._task: Optional[asyncio.Task] = None
+        self._failed: Optional[str] = None  # Loại index train lỗi, không thử lại liên tục
+        self._saved_ann: Optional[faiss.Index] = None
+        self._saved_total = 0
+
+    @property
+    def ntotal(self) -> int:
+        return self.raw.ntotal
+
+    @property
+    def d(self) -> int:
+        return self.raw.d
+
+    @property
+    def kind(self) -> str:
+        return index_kind(self.ann)
+
+    def add(self, x: np.ndarray):
+        self.raw.add(x)
+        if self.ann is not None:
+            self.ann.add(x)
+        self.maybe_upgrade()
+
+    def search(self, x: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        ann = self.ann
+        if ann is None:
+            return self.raw.search(x, k)
+        _, candidates = ann.search(x, k * settings.MEMORY_ANN_REFINE)
+        similarity = self.raw.metric_type == faiss.METRIC_INNER_PRODUCT
+        D = np.full((len(x), k), -np.inf if similarity else np.inf, dtype="float32")
+        I = np.full((len(x), k), -1, dtype="int64")
+        for row, ids in enumerate(candidates):
+            ids = ids[ids >= 0]
+            if not len(ids):
+                continue
+            vectors = self.raw.reconstruct_batch(ids)
+            if similarity:
+                exact = vectors @ x[row]
+                order = np.argsort(-exact, kind="stable")[:k]
+            else:
+                exact = ((vectors - x[row]) ** 2).sum(axis=1)
+                order = np.argsort(exact, kind="stable")[:k]
+            D[row, : len(order)] = exact[order]
+            I[row, : len(order)] = ids[order]
+        return D, I
+
+    def rebase(self, base: faiss.Index):
+        self.raw.rebase(base)
+
+    def snapshot(self) -> faiss.Index:
+        """Snapshot vector gốc; index xấp xỉ chỉ ghi lại khi mới swap hoặc đã lệch nhiều so với bản trên đĩa."""
+        base = self.persistence.snapshot(self.raw)
+        ann = self.ann
+        if ann is not None and (
+            ann is not self._saved_ann or ann.ntotal - self._saved_total > self._saved_total // 10
+        ):
+            self.persistence.save_ann(ann)
+            self._saved_ann, self._saved_total = ann, ann.ntotal
+        return base
+
+    @property
+    def upgrading(self) -> bool:
+        """Đang train / đọc index ANN ở nền."""
+        return self._task is not None and not self._task.done()
+
+    def maybe_upgrade(self):
+        """Bắt đầu train nền nếu số vector đã vượt ngưỡng của loại index kế tiếp."""
+        if self.upgrading:
+            return
+        target = target_kind(self.raw.ntotal)
+        if KINDS.index(target) <= KINDS.index(self.kind) or target == self._failed:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._task = loop.create_task(self._upgrade(target))
+
+    async def _load_saved(self, target: str) -> Optional[faiss.Index]:
+        if self.persistence is None:
+            return None
+        ann = await asyncio.to_thread(self.persistence.load_ann)
+        if ann is None or index_kind(ann) != target or ann.d != self.raw.d or ann.ntotal > self.raw.ntotal:
+            return None
+        self._saved_ann, self._saved_total = ann, ann.ntotal
+        return ann
+
+    async def _upgrade(self, target: str):
+        started = time.perf_counter()
+        try:
+            ann = await self._load_saved(target)
+            source = "đĩa"
+            if ann is None:
+                source = "train"
+                # Copy tail trên event loop (tail có thể được add song song); base mmap chỉ đọc nên đọc trong thread
+                base = self.raw.base
+                base_total = base.ntotal if base is not None else 0
+                tail = self.raw.tail.reconstruct_n(0, self.raw.tail.ntotal) if self.raw.tail.ntotal else None
+
+                def collect() -> np.ndarray:
+                    parts = [base.reconstruct_n(0, base_total)] if base_total else []
+                    if tail is not None:
+                        parts.append(tail)
+                    return np.ascontiguousarray(np.concatenate(parts))
+
+                vectors = await asyncio.to_thread(collect)
+                ann = await asyncio.to_thread(build_ann, target, vectors, self.raw.metric_type)
+                del vectors
+            # Bù các vector thêm vào raw trong lúc train/đọc file rồi swap trong cùng một bước đồng bộ
+            if self.raw.ntotal > ann.ntotal:
+                ann.add(self.raw.reconstruct_n(ann.ntotal, self.raw.ntotal - ann.ntotal))
+            configure_search(ann)
+            previous = self.kind
+            self.ann = ann
+            metrics.inc("memory_index_upgrades")
+            logger.info(
+                f"Memory index {previous} -> {target} ({source}, {ann.ntotal} vector, "
+                f"{time.perf_counter() - started:.1f}s)"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failed = target
+            logger.warning(f"Không chuyển được memory index sang {target}, giữ {self.kind}: {e}")
+
+    async def close(self):
+        """Dừng train nền (khi tắt server); thread đang chạy tự kết thúc, kết quả bị bỏ."""
+        if self.upgrading:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
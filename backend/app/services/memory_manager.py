@@ -1,45 +1,288 @@
 # app/services/memory_manager.py
+import asyncio
+import time
+from collections import deque
 from app.utils.logger import logger
-import faiss
 import numpy as np
 from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from app.services.session_manager import SessionManager
-from app.utils.embed import embed_text  # Import hàm chung
+from app.utils.embed import embed_text, truncate_embedding  # Import hàm chung
+from app.services.context_builder import format_relevant_memory
+from app.config import settings
+from app.services.memory_columns import MemoryColumns
+from app.services.memory_compactor import memory_compactor
+from app.services.memory_index import AdaptiveIndex
+from app.services.memory_store import MappedIndex, MemoryStore, l2_normalize
+from app.services.memory_writer import MemoryJob, memory_writer
+from app.utils.bm25 import BM25Index, tokenize
+from app.utils.metrics import metrics
+
+def build_lexical_index(store: MemoryColumns) -> BM25Index:
+    """BM25 song song với store (doc id = id memory)."""
+    lexical = BM25Index()
+    for content in store.contents():
+        lexical.add(tokenize(content))
+    return lexical
+
 
 class HybridMemory:
-    def __init__(self, dim=1024, max_short=20):
-        self.short_history = []
+    def __init__(
+        self,
+        dim=768,
+        max_short=20,
+        persistence: Optional[MemoryStore] = None,
+        snapshot_every=256,
+        duplicate_similarity=0.97,
+    ):
+        self.short_history = deque()
+        self.short_vectors = deque()  # vector song song với short_history (None nếu embed lỗi)
         self.max_short = max_short
-        self.index = faiss.IndexFlatL2(dim)  # FAISS vector store
-        self.store = []  # metadata song song với FAISS
+        self.total_messages = 0  # Tổng số message đã thêm (vị trí tuyệt đối cho cửa sổ history)
+        raw = MappedIndex(dim)  # FAISS vector store (Flat, tự chuyển sang HNSW/IVF-PQ khi lớn)
+        self.store = MemoryColumns()  # metadata song song với FAISS (dạng cột, content trên đĩa nếu persist)
+        self.persistence = persistence
+        self.snapshot_every = snapshot_every
+        self.duplicate_similarity = duplicate_similarity  # Cosine từ ngưỡng này (cùng role) coi là trùng
+        self._lock = asyncio.Lock()  # Không sửa index trong lúc đang ghi snapshot ở thread khác
+        self._pending: Set[int] = set()  # Vị trí tuyệt đối của message đã gửi memory_writer nhưng chưa xử lý xong
+        self.compacting = False  # Đang nằm trong queue / được memory_compactor tóm tắt
+        self._writing = 0  # Số lượt apply_vectors/flush đang chạy (có thể đang chờ ghi snapshot)
+        if persistence is not None:
+            raw, self.store = persistence.load()
+        # Kênh từ khóa song song với FAISS; memory mở từ đĩa dựng lại khi retrieve lần đầu
+        self.lexical: Optional[BM25Index] = BM25Index() if len(self.store) == 0 else None
+        self.index = AdaptiveIndex(raw, persistence)
+        self.index.maybe_upgrade()
+        if persistence is not None:
+            history, vectors, self.total_messages = persistence.load_short()
+            self.short_history = deque(history)
+            self.short_vectors = deque(self._fit(vec) for vec in vectors)
 
-    async def add_message(self, role: str, content: str):
-        """Lưu message vào short-term, nếu tràn thì đẩy vào FAISS"""
-        self.short_history.append({"role": role, "content": content})
+    async def add_message(self, role: str, content: str, vec: np.ndarray | None = None):
+        """Thêm message vào short-term ngay; embedding và ghi FAISS do memory_writer làm nền theo batch."""
+        entry = {"role": role, "content": content}
+        self.short_history.append(entry)
+        vec = self._fit(vec)
+        self.short_vectors.append(vec)
+        self.total_messages += 1
+        jobs = [MemoryJob(self, entry, vec, self.total_messages - 1)]
         if len(self.short_history) > self.max_short:
-            old = self.short_history.pop(0)
-            vec = await embed_text(old["content"])  # Dùng hàm chung
-            if vec is not None:
-                self.index.add(np.expand_dims(vec, 0))
-                self.store.append({"role": old["role"], "content": old["content"], "time": datetime.utcnow()})
+            old = self.short_history.popleft()
+            old_vec = self.short_vectors.popleft()
+            old_position = self.total_messages - len(self.short_history) - 1
+            if old_position in self._pending:
+                pass  # Job của message này chưa xử lý: writer thấy nó đã rời short-term thì tự đưa vào FAISS
+            elif old_vec is not None:
+                jobs.append(MemoryJob(self, old, old_vec, old_position))
             else:
                 logger.warning("Bỏ qua embed cho old message do lỗi")
+        self._pending.update(job.position for job in jobs)
+        for job in jobs:
+            if not memory_writer.submit(job):
+                await memory_writer.process([job])
 
-    async def retrieve(self, query: str, k=5):
-        """Semantic search từ FAISS"""
+    @property
+    def pending_writes(self) -> int:
+        """Số message còn chờ memory_writer xử lý (tính cả lượt tóm tắt nền và lượt ghi snapshot đang chạy)."""
+        return len(self._pending) + int(self.compacting) + self._writing
+
+    def release_pending(self, positions: Iterable[int]):
+        """Bỏ các message khỏi danh sách chờ writer (writer gọi sau mỗi batch, kể cả khi batch lỗi)."""
+        self._pending.difference_update(positions)
+
+    async def apply_vectors(self, updates: List[Tuple[int, Dict, Optional[np.ndarray]]]):
+        """Gắn vector vào message còn trong short-term, message đã rời short-term thì ghi vào FAISS (chỉ writer gọi)."""
+        # Giữ pending_writes > 0 tới khi snapshot ghi xong để memory_registry không evict giữa chừng
+        self._writing += 1
+        try:
+            await self._apply_vectors(updates)
+        finally:
+            self._writing -= 1
+        memory_compactor.notify(self)
+
+    async def _apply_vectors(self, updates: List[Tuple[int, Dict, Optional[np.ndarray]]]):
+        async with self._lock:
+            for position, entry, vec in updates:
+                # Bỏ khỏi _pending ngay: từ đây message rời short-term thì add_message phải tự gửi job spill
+                self._pending.discard(position)
+                vec = self._fit(vec)
+                position = next((i for i, item in enumerate(self.short_history) if item is entry), None)
+                if position is not None:
+                    self.short_vectors[position] = vec
+                    if vec is None:
+                        logger.warning("Không embed được message mới, lưu không kèm vector")
+                elif vec is not None:
+                    self._add_long_term(entry["role"], entry["content"], l2_normalize(vec))
+                else:
+                    logger.warning("Bỏ qua embed cho old message do lỗi")
+            if self.persistence is not None:
+                await asyncio.to_thread(
+                    self.persistence.save_short, list(self.short_history), list(self.short_vectors), self.total_messages
+                )
+                if self.persistence.pending >= self.snapshot_every:
+                    self.index.rebase(await asyncio.to_thread(self.index.snapshot))
+
+    async def add_summary(self, content: str, vec: np.ndarray, level: int, span: Tuple[int, int]):
+        """Thêm summary tầng `level` của các entry trong [span) vào FAISS (chỉ memory_compactor gọi)."""
+        vec = self._fit(vec)
+        if vec is None:
+            return
+        async with self._lock:
+            self.store.append("summary", content, datetime.utcnow(), level=level, span=span)
+            if self.lexical is not None:
+                self.lexical.add(tokenize(content))
+            self.index.add(np.expand_dims(l2_normalize(vec), 0))
+            if self.persistence is not None:
+                self.persistence.append(l2_normalize(vec))
+
+    def _fit(self, vec: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Đưa vector về số chiều của index: cắt Matryoshka nếu dài hơn, None nếu ngắn hơn (không dùng được).
+
+        Memory giữ số chiều lúc tạo; đổi EMBED_TRUNCATE_DIM chỉ cắt được xuống (xem MemoryStore.load).
+        """
+        if vec is None or len(vec) == self.index.d:
+            return vec
+        if len(vec) > self.index.d:
+            return truncate_embedding(vec, self.index.d)
+        logger.warning(f"Bỏ vector {len(vec)} chiều, memory dùng {self.index.d} chiều")
+        return None
+
+    def _find_duplicate(self, role: str, vec: np.ndarray) -> Optional[int]:
+        """Id của message gốc cùng role có cosine >= duplicate_similarity với `vec` (đã chuẩn hóa), nếu có.
+
+        Xét vài láng giềng gần nhất: hit đầu tiên có thể là summary (tầng khác) hoặc entry đã bị prune,
+        khi đó message trùng thật xếp thứ 2-3 vẫn được gộp.
+        """
         if self.index.ntotal == 0:
+            return None
+        D, I = self.index.search(np.expand_dims(vec, 0), settings.MEMORY_DUPLICATE_CANDIDATES)
+        levels, parents = self.store.levels, self.store.parents
+        for similarity, i in zip(D[0], I[0].tolist()):
+            if i < 0 or i >= len(self.store):
+                continue
+            if similarity < self.duplicate_similarity:
+                break  # Kết quả sắp theo cosine giảm dần
+            if self.store.role_names[self.store.roles[i]] != role or levels[i] != 0:
+                continue
+            if settings.MEMORY_SUMMARY_PRUNE_RAW and parents[i] >= 0:
+                continue  # Đã bị prune khỏi retrieve: gộp vào đây thì message mới không bao giờ được trả về
+            return i
+        return None
+
+    def _add_long_term(self, role: str, content: str, vec: np.ndarray):
+        duplicate = self._find_duplicate(role, vec)
+        if duplicate is not None:
+            # "ok", "cảm ơn"... lặp lại: tăng hit counter thay vì thêm vector gần như giống hệt
+            self.store.add_hit(duplicate)
+            metrics.inc("memory_duplicates_merged")
+            return
+        # Metadata ghi trước vector (xem MemoryStore.load)
+        self.store.append(role, content, datetime.utcnow())
+        if self.lexical is not None:
+            self.lexical.add(tokenize(content))
+        self.index.add(np.expand_dims(vec, 0))
+        if self.persistence is not None:
+            self.persistence.append(vec)
+
+    async def flush(self):
+        """Gộp WAL vào snapshot (gọi khi tắt server) để lần mở sau không phải replay."""
+        await self.index.close()
+        if self.persistence is None or self.persistence.pending == 0:
+            return
+        self._writing += 1
+        try:
+            async with self._lock:
+                self.index.rebase(await asyncio.to_thread(self.index.snapshot))
+        finally:
+            self._writing -= 1
+
+    def vector_count(self) -> int:
+        """Số vector đang giữ trong RAM (FAISS + short-term)."""
+        return self.index.ntotal + sum(1 for vec in self.short_vectors if vec is not None)
+
+    def _covered(self, i: int, selected: set) -> bool:
+        """Entry `i` đã nằm trong một summary được chọn (hoặc đã được tóm tắt khi bật prune)."""
+        parents = self.store.parents
+        if settings.MEMORY_SUMMARY_PRUNE_RAW and self.store.levels[i] == 0 and parents[i] >= 0:
+            return True
+        while parents[i] >= 0:
+            i = int(parents[i])
+            if i in selected:
+                return True
+        return False
+
+    async def _lexical_index(self) -> BM25Index:
+        """BM25 của memory dài hạn; memory mở từ đĩa dựng lại (trong thread) ở lần retrieve đầu tiên."""
+        if self.lexical is None:
+            async with self._lock:
+                if self.lexical is None:
+                    started = time.perf_counter()
+                    self.lexical = await asyncio.to_thread(build_lexical_index, self.store)
+                    logger.debug(f"Dựng BM25 cho {len(self.lexical)} memory trong {time.perf_counter() - started:.2f}s")
+        return self.lexical
+
+    async def retrieve(self, query: str, k=5):
+        """Tìm memory liên quan bằng vector (FAISS) + từ khóa (BM25); embed lỗi thì chỉ dùng BM25."""
+        if len(self.store) == 0:
             return []
-        qvec = await embed_text(query)  # Dùng hàm chung
-        if qvec is None:
+        qvec = self._fit(await embed_text(query))  # Dùng hàm chung
+        await self._lexical_index()
+        return self.search(query, l2_normalize(qvec) if qvec is not None else None, k)
+
+    def search(self, query: str, qvec: Optional[np.ndarray], k: int = 5) -> List[Dict]:
+        """Gộp hai kênh bằng reciprocal-rank fusion, nhân trọng số thời gian, rồi chọn k memory.
+
+        Summary (tầng cao trước) đứng trước message gốc; bỏ entry đã nằm trong summary được chọn.
+        """
+        size = len(self.store)
+        # Lấy dư ứng viên để còn đủ k sau khi bỏ message đã nằm trong summary
+        depth = min(k * 4, size)
+        rrf_k = settings.MEMORY_RRF_K
+        fused: Dict[int, float] = {}
+        if qvec is not None and self.index.ntotal:
+            _, I = self.index.search(np.expand_dims(qvec, 0), min(depth, self.index.ntotal))
+            for rank, i in enumerate(i for i in I[0].tolist() if 0 <= i < size):
+                fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+        if self.lexical is not None and len(self.lexical):
+            scores = self.lexical.scores(tokenize(query))
+            top = np.argpartition(-scores, depth - 1)[:depth] if depth < len(scores) else np.arange(len(scores))
+            top = top[scores[top] > 0]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            for rank, i in enumerate(top.tolist()):
+                fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+        if not fused:
             return []
-        D, I = self.index.search(np.expand_dims(qvec, 0), k)
+
+        ids = np.fromiter(fused, dtype=np.int64, count=len(fused))
+        score = np.fromiter(fused.values(), dtype=np.float64, count=len(fused))
+        weight = settings.MEMORY_RECENCY_WEIGHT
+        if weight:
+            # Nửa điểm còn lại sau mỗi half-life: (1 - weight) giữ nguyên, weight giảm theo tuổi của memory
+            age = (np.datetime64(datetime.utcnow(), "us") - self.store.times[ids]) / np.timedelta64(1, "h")
+            decay = 0.5 ** (np.maximum(age, 0) / settings.MEMORY_RECENCY_HALF_LIFE_HOURS)
+            score *= (1 - weight) + weight * decay
+        order = np.lexsort((-score, -self.store.levels[ids].astype(np.int64)))
+        selected = set()
         results = []
-        for i in I[0]:
-            if i < len(self.store):
-                results.append(self.store[i])
+        for i in ids[order].tolist():
+            if len(results) == k:
+                break
+            if self._covered(i, selected):
+                continue
+            selected.add(i)
+            results.append(self.store[i])
         return results
 
+    async def build_context_with_vectors(self, query: str):
+        """Ghép short-term + semantic search, trả kèm vector song song (None với message không có vector)"""
+        history = list(self.short_history)
+        vectors = list(self.short_vectors)
+        relevant = await self.retrieve(query)
+        messages = history + [{"role": "system", "content": f"Relevant memory:\n{format_relevant_memory(relevant)}"}]
+        return messages, vectors + [None]
+
     async def build_context(self, query: str):
         """Ghép short-term + semantic search"""
-        relevant = await self.retrieve(query)
-        return self.short_history + [{"role": "system", "content": f"Relevant memory: {relevant}"}]
+        messages, _ = await self.build_context_with_vectors(query)
+        return messages
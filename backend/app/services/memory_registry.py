@@ -0,0 +1,169 @@
+# app/services/memory_registry.py
+import asyncio
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+
+from app.config import settings
+from app.services.memory_manager import HybridMemory
+from app.services.memory_store import MemoryStore, conversation_dir
+from app.utils.embed import detect_embedding_dim
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+
+class MemoryRegistry:
+    """Quản lý HybridMemory riêng cho từng conversation_id, evict LRU khi vượt giới hạn.
+
+    Khi có `directory`, memory được lưu xuống đĩa: evict chỉ bỏ bản trong RAM, lần `get` sau mở lại
+    từ snapshot (mmap) + WAL. Không nạp trước conversation nào nên khởi động không chậm theo dữ liệu.
+    Việc mở (đọc snapshot, replay WAL, sửa số chiều) chạy trong thread để không chặn các request khác.
+    """
+
+    def __init__(
+        self,
+        dim: int = 768,
+        max_short: int = 20,
+        max_conversations: int = 256,
+        max_resident_vectors: int = 200_000,
+        directory: str = "",
+        snapshot_every: int = 256,
+        duplicate_similarity: float = 0.97,
+        retention_days: int = 0,
+    ):
+        self._memories: "OrderedDict[str, HybridMemory]" = OrderedDict()
+        self._loading: Dict[str, "asyncio.Task[HybridMemory]"] = {}  # Conversation đang mở từ đĩa
+        self.dim = dim
+        self.max_short = max_short
+        self.max_conversations = max_conversations
+        self.max_resident_vectors = max_resident_vectors
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.duplicate_similarity = duplicate_similarity
+        self.retention_days = retention_days
+
+    async def detect_dim(self):
+        """Lấy số chiều memory từ embedding model lúc khởi động; không đo được thì giữ MEMORY_DIM."""
+        dim = await detect_embedding_dim()
+        if dim is None:
+            logger.warning(f"Không đo được số chiều embedding, memory dùng MEMORY_DIM={self.dim}")
+            return
+        if dim != self.dim:
+            logger.info(f"Memory dùng {dim} chiều theo embedding model (MEMORY_DIM={self.dim})")
+        self.dim = dim
+
+    async def get(self, conversation_id: str) -> HybridMemory:
+        """Lấy (hoặc tạo) memory của conversation và đánh dấu vừa được dùng."""
+        memory = self._memories.get(conversation_id)
+        if memory is None:
+            # Các request đồng thời của cùng conversation chờ chung một lần mở (không tạo hai bản cùng ghi đĩa)
+            loading = self._loading.get(conversation_id)
+            if loading is None:
+                loading = asyncio.get_running_loop().create_task(self._open(conversation_id))
+                self._loading[conversation_id] = loading
+            memory = await asyncio.shield(loading)  # Request bị hủy không làm hỏng lượt mở của request khác
+        self._memories.move_to_end(conversation_id)
+        self.enforce_limits()
+        return memory
+
+    def _create(self, conversation_id: str) -> HybridMemory:
+        persistence = None
+        if self.directory:
+            persistence = MemoryStore(conversation_dir(self.directory, conversation_id), self.dim)
+        return HybridMemory(
+            dim=self.dim,
+            max_short=self.max_short,
+            persistence=persistence,
+            snapshot_every=self.snapshot_every,
+            duplicate_similarity=self.duplicate_similarity,
+        )
+
+    async def _open(self, conversation_id: str) -> HybridMemory:
+        try:
+            memory = await asyncio.to_thread(self._create, conversation_id)
+        finally:
+            del self._loading[conversation_id]
+        memory.index.maybe_upgrade()  # Cần event loop, trong thread không bắt đầu được train nền
+        self._memories[conversation_id] = memory
+        if memory.total_messages:
+            logger.info(
+                f"Mở lại memory của conversation {conversation_id} "
+                f"({memory.total_messages} message, {memory.index.ntotal} vector)"
+            )
+        else:
+            logger.info(f"Tạo memory mới cho conversation {conversation_id}")
+        return memory
+
+    def resident_vectors(self) -> int:
+        """Tổng số vector đang giữ trong RAM của mọi conversation."""
+        return sum(memory.vector_count() for memory in self._memories.values())
+
+    def enforce_limits(self):
+        """Evict conversation ít dùng nhất cho tới khi về dưới giới hạn (luôn giữ conversation mới nhất).
+
+        Bỏ qua memory còn job trong memory_writer: evict lúc đó rồi mở lại sẽ có hai bản cùng ghi một thư mục.
+        Cũng bỏ qua memory đang train index ANN nền: thread train vẫn giữ bản copy vector (evict không giải
+        phóng được RAM) và sẽ lưu file ANN song song với bản mở lại; evict ở lượt sau khi train xong.
+        """
+        total = self.resident_vectors()
+        for conversation_id in list(self._memories)[:-1]:
+            if len(self._memories) <= self.max_conversations and total <= self.max_resident_vectors:
+                break
+            memory = self._memories[conversation_id]
+            if memory.pending_writes or memory.index.upgrading:
+                continue
+            del self._memories[conversation_id]
+            total -= memory.vector_count()
+            logger.info(
+                f"Evict memory của conversation {conversation_id} ({memory.vector_count()} vector), "
+                f"còn {len(self._memories)} conversation / {total} vector"
+            )
+
+    def cleanup(self) -> int:
+        """Xóa thư mục memory của conversation không ghi gì quá `retention_days` ngày, trả về số thư mục đã xóa.
+
+        Thời điểm dùng cuối là mtime mới nhất của các file trong thư mục (mỗi lượt chat đều ghi WAL/JSONL).
+        Bỏ qua conversation đang mở trong RAM. Gọi lúc khởi động (blocking, chạy trong thread).
+        """
+        if not self.directory or self.retention_days <= 0 or not Path(self.directory).is_dir():
+            return 0
+        cutoff = time.time() - self.retention_days * 86400
+        loaded = {conversation_dir(self.directory, conversation_id) for conversation_id in self._memories}
+        removed = 0
+        for path in Path(self.directory).iterdir():
+            if not path.is_dir() or path in loaded:
+                continue
+            try:
+                last_used = max((item.stat().st_mtime for item in path.iterdir()), default=path.stat().st_mtime)
+                if last_used < cutoff:
+                    shutil.rmtree(path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"Không dọn được memory {path}: {e}")
+        if removed:
+            logger.info(f"Đã xóa memory của {removed} conversation không dùng quá {self.retention_days} ngày")
+        return removed
+
+    async def flush(self):
+        """Ghi snapshot cho mọi memory còn vector trong WAL."""
+        for memory in list(self._memories.values()):
+            await memory.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {"conversations": len(self._memories), "resident_vectors": self.resident_vectors()}
+
+
+# Khởi tạo singleton instance
+memory_registry = MemoryRegistry(
+    dim=settings.MEMORY_DIM,
+    max_short=settings.MEMORY_MAX_SHORT,
+    max_conversations=settings.MEMORY_MAX_CONVERSATIONS,
+    max_resident_vectors=settings.MEMORY_MAX_RESIDENT_VECTORS,
+    directory=settings.MEMORY_DIR,
+    snapshot_every=settings.MEMORY_SNAPSHOT_EVERY,
+    duplicate_similarity=settings.MEMORY_DUPLICATE_SIMILARITY,
+    retention_days=settings.MEMORY_RETENTION_DAYS,
+)
+metrics.register("memory", memory_registry.stats)
@@ -0,0 +1,340 @@
+# app/services/memory_store.py
+import hashlib
+import json
+import os
+import re
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from app.services.memory_columns import MemoryColumns
+from app.utils.logger import logger
+
+_SAFE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_WAL_MAGIC = b"WAL2"
+_WAL_HEADER = struct.Struct("<4sIq")  # magic, số chiều vector, ntotal của snapshot mà WAL nối tiếp
+_LEGACY_WAL_HEADER = struct.Struct("<q")  # WAL cũ chỉ có ntotal (số chiều lấy theo snapshot / cấu hình)
+
+
+def conversation_dir(root: str, conversation_id: str) -> Path:
+    """Thư mục lưu memory của conversation; id lạ (../, ký tự đặc biệt, quá dài) được băm để không thoát khỏi root."""
+    if _SAFE_ID_RE.match(conversation_id):
+        name = conversation_id
+    else:
+        name = "h-" + hashlib.sha256(conversation_id.encode("utf-8")).hexdigest()[:32]
+    return Path(root) / name
+
+
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa L2 theo hàng: inner product của vector đã chuẩn hóa chính là cosine similarity."""
+    x = np.asarray(x, dtype="float32")
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _atomic_write(path: Path, data: bytes):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class MappedIndex:
+    """Index FAISS gồm snapshot mmap (chỉ đọc) + phần tail trong RAM nhận vector mới.
+
+    FAISS không cho sửa index mở bằng IO_FLAG_MMAP_IFC, nên vector mới vào tail; snapshot kế tiếp
+    gộp hai phần thành file mới rồi `rebase` sang bản mmap của file đó.
+    """
+
+    def __init__(self, dim: int, base: Optional[faiss.Index] = None, metric_type: int = faiss.METRIC_INNER_PRODUCT):
+        self.base = base
+        self.d = base.d if base is not None else dim
+        self.metric_type = base.metric_type if base is not None else metric_type
+        self.tail = faiss.IndexFlat(self.d, self.metric_type)
+
+    @property
+    def ntotal(self) -> int:
+        return (self.base.ntotal if self.base is not None else 0) + self.tail.ntotal
+
+    def add(self, x: np.ndarray):
+        self.tail.add(x)
+
+    def rebase(self, base: faiss.Index):
+        """Dùng snapshot mới (đã chứa toàn bộ tail) làm base."""
+        self.base = base
+        self.tail = faiss.IndexFlat(self.d, self.metric_type)
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        base_total = self.base.ntotal if self.base is not None else 0
+        return self.base.reconstruct(i) if i < base_total else self.tail.reconstruct(i - base_total)
+
+    def reconstruct_n(self, start: int, count: int) -> np.ndarray:
+        base_total = self.base.ntotal if self.base is not None else 0
+        parts = []
+        if start < base_total:
+            parts.append(self.base.reconstruct_n(start, min(count, base_total - start)))
+        end = start + count
+        if end > base_total:
+            tail_start = max(start, base_total) - base_total
+            parts.append(self.tail.reconstruct_n(tail_start, end - base_total - tail_start))
+        return np.concatenate(parts) if parts else np.empty((0, self.d), dtype="float32")
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        """Vector gốc theo danh sách id (dùng để refine kết quả của index xấp xỉ)."""
+        base_total = self.base.ntotal if self.base is not None else 0
+        out = np.empty((len(ids), self.d), dtype="float32")
+        in_base = ids < base_total
+        if in_base.any():
+            out[in_base] = self.base.reconstruct_batch(ids[in_base])
+        if not in_base.all():
+            out[~in_base] = self.tail.reconstruct_batch(ids[~in_base] - base_total)
+        return out
+
+    def merged(self) -> faiss.Index:
+        """Bản index phẳng trong RAM chứa mọi vector (dùng để ghi snapshot)."""
+        merged = faiss.IndexFlat(self.d, self.metric_type)
+        if self.ntotal:
+            merged.add(self.reconstruct_n(0, self.ntotal))
+        return merged
+
+    def search(self, x: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search cả base và tail rồi gộp top-k (id của tail nối tiếp sau base)."""
+        distances, ids = [], []
+        offset = 0
+        for index in (self.base, self.tail):
+            if index is None:
+                continue
+            if index.ntotal:
+                D, I = index.search(x, min(k, index.ntotal))
+                distances.append(D)
+                ids.append(np.where(I >= 0, I + offset, -1))
+            offset += index.ntotal
+        similarity = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        pad = -np.inf if similarity else np.inf
+        distances.append(np.full((len(x), k), pad, dtype="float32"))
+        ids.append(np.full((len(x), k), -1, dtype="int64"))
+        D = np.concatenate(distances, axis=1)
+        I = np.concatenate(ids, axis=1)
+        order = np.argsort(-D if similarity else D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+
+class MemoryStore:
+    """Lưu memory dài hạn của một conversation xuống đĩa.
+
+    - `index.faiss`: snapshot FAISS (faiss.write_index), mở lại bằng mmap nên không phải đọc hết vào RAM
+      (thời gian mở không tăng theo số vector).
+    - `wal.f32`: vector thêm sau snapshot (append-only), replay khi mở lại rồi gộp vào snapshot kế tiếp.
+    - `store.jsonl`: metadata append-only, dòng thứ i ứng với vector thứ i của index; `store.idx.npz`
+      giữ cột role/time/offset (ghi cùng snapshot) để mở lại chỉ parse phần JSONL ghi sau đó.
+    - `short.json` + `short.npy`: short-term history (ghi đè mỗi lượt, nhỏ).
+    """
+
+    def __init__(self, directory: Path, dim: int):
+        self.directory = directory
+        self.dim = dim
+        self.pending = 0  # Số vector nằm trong WAL, chưa vào snapshot
+        self.columns: Optional[MemoryColumns] = None
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / "index.faiss"
+
+    @property
+    def wal_path(self) -> Path:
+        return self.directory / "wal.f32"
+
+    @property
+    def meta_path(self) -> Path:
+        return self.directory / "store.jsonl"
+
+    @property
+    def meta_index_path(self) -> Path:
+        return self.directory / "store.idx.npz"
+
+    @property
+    def hits_path(self) -> Path:
+        return self.directory / "hits.i64"
+
+    @property
+    def ann_path(self) -> Path:
+        return self.directory / "ann.faiss"
+
+    def _wal_header(self, dim: int, base: int) -> bytes:
+        return _WAL_HEADER.pack(_WAL_MAGIC, dim, base)
+
+    def _read_wal(self) -> Tuple[int, np.ndarray]:
+        """(ntotal snapshot mà WAL nối tiếp, vector trong WAL theo đúng số chiều lúc ghi)."""
+        if not self.wal_path.exists() or self.wal_path.stat().st_size < _LEGACY_WAL_HEADER.size:
+            return 0, np.empty((0, self.dim), dtype="float32")
+        with open(self.wal_path, "rb") as f:
+            data = f.read()
+        if data[:4] == _WAL_MAGIC and len(data) >= _WAL_HEADER.size:
+            _, dim, base = _WAL_HEADER.unpack_from(data)
+            raw = memoryview(data)[_WAL_HEADER.size:]
+        else:
+            dim = self.dim
+            (base,) = _LEGACY_WAL_HEADER.unpack_from(data)
+            raw = memoryview(data)[_LEGACY_WAL_HEADER.size:]
+        count = len(raw) // (dim * 4)  # Bỏ record ghi dở
+        vectors = np.frombuffer(raw, dtype="float32", count=count * dim)
+        return base, vectors.reshape(count, dim)
+
+    def _open_snapshot(self) -> Optional[faiss.Index]:
+        if not self.index_path.exists():
+            return None
+        return faiss.read_index(str(self.index_path), faiss.IO_FLAG_MMAP_IFC)
+
+    def load(self) -> Tuple[MappedIndex, MemoryColumns]:
+        """Mở snapshot (mmap), replay WAL và đối chiếu với metadata để khôi phục sau crash."""
+        base = self._open_snapshot()
+        target_dim = self.dim
+        if base is not None:
+            self.dim = base.d
+        base_total = base.ntotal if base is not None else 0
+
+        wal_base, wal_vectors = self._read_wal()
+        wal_dim = wal_vectors.shape[1]
+        if wal_dim != self.dim and len(wal_vectors):
+            if base is None:
+                # Chỉ có WAL (crash trước snapshot đầu): giữ số chiều lúc ghi, bước cắt bên dưới đưa về target
+                self.dim = wal_dim
+            elif wal_dim > self.dim:
+                logger.warning(f"WAL tại {self.directory} có {wal_dim} chiều, cắt còn {self.dim} như snapshot")
+                wal_vectors = l2_normalize(wal_vectors[:, : self.dim])
+            else:
+                logger.error(
+                    f"WAL tại {self.directory} có {wal_dim} chiều, ít hơn snapshot ({self.dim}): bỏ {len(wal_vectors)} vector"
+                )
+                wal_vectors = np.empty((0, self.dim), dtype="float32")
+        # Crash ngay sau khi ghi snapshot mới nhưng trước khi reset WAL: phần đầu WAL đã có trong snapshot
+        skip = max(0, base_total - wal_base)
+        wal_vectors = wal_vectors[skip:]
+        store, meta_size = MemoryColumns.open(self.meta_path, self.meta_index_path, self.hits_path)
+        self.columns = store
+
+        # Metadata được ghi trước vector nên thường chỉ dư metadata (hoặc thiếu vector ghi dở)
+        count = min(base_total + len(wal_vectors), len(store))
+        repaired = bool(skip)
+        if base_total > count:
+            # Snapshot nhiều vector hơn metadata (file bị sửa ngoài): chép phần hợp lệ ra RAM
+            vectors = base.reconstruct_n(0, count) if count else np.empty((0, self.dim), dtype="float32")
+            index = MappedIndex(self.dim, metric_type=base.metric_type)
+            index.add(vectors)
+            repaired = True
+        else:
+            index = MappedIndex(self.dim, base)
+            if count > base_total:
+                index.add(np.ascontiguousarray(wal_vectors[: count - base_total]))
+            repaired = repaired or len(wal_vectors) > count - base_total
+        if len(store) > count or meta_size != store.data_size:
+            store.truncate(count)
+            repaired = True
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            # Snapshot cũ (IndexFlatL2, vector chưa chuẩn hóa): chuyển một lần sang inner product / cosine
+            logger.info(f"Chuyển memory tại {self.directory} sang vector chuẩn hóa + inner product")
+            vectors = l2_normalize(index.reconstruct_n(0, index.ntotal))
+            index = MappedIndex(self.dim)
+            index.add(vectors)
+            repaired = True
+        if index.d > target_dim:
+            # Bật cắt Matryoshka (EMBED_TRUNCATE_DIM) sau khi đã lưu vector đầy đủ: cắt một lần, chuẩn hóa lại
+            logger.info(f"Cắt vector memory tại {self.directory} từ {index.d} còn {target_dim} chiều")
+            vectors = l2_normalize(index.reconstruct_n(0, index.ntotal)[:, :target_dim])
+            self.dim = target_dim
+            index = MappedIndex(self.dim)
+            index.add(vectors)
+            repaired = True
+
+        if repaired:
+            logger.warning(f"Khôi phục memory tại {self.directory}: {count} vector sau khi đối chiếu WAL/metadata")
+            self.ann_path.unlink(missing_ok=True)  # Index xấp xỉ có thể chứa id đã bị cắt, train lại
+            index.rebase(self.snapshot(index))
+        else:
+            self.pending = index.tail.ntotal
+        return index, store
+
+    def read_vectors(self) -> np.ndarray:
+        """Toàn bộ vector (snapshot + WAL) dạng float32, chỉ đọc, không đối chiếu/sửa file (dùng cho benchmark)."""
+        base = self._open_snapshot()
+        if base is not None:
+            self.dim = base.d
+        base_total = base.ntotal if base is not None else 0
+        wal_base, wal_vectors = self._read_wal()
+        parts = [base.reconstruct_n(0, base_total)] if base_total else []
+        if base is None or wal_vectors.shape[1] == self.dim:
+            parts.append(wal_vectors[max(0, base_total - wal_base):])
+        return np.concatenate(parts)
+
+    def append(self, vec: np.ndarray):
+        """Ghi vector vào WAL; caller ghi metadata (`columns.append`) trước, crash giữa hai bước được sửa khi load."""
+        new_wal = not self.wal_path.exists()
+        with open(self.wal_path, "ab") as f:
+            if new_wal:
+                f.write(self._wal_header(self.dim, 0))
+            f.write(np.asarray(vec, dtype="float32").reshape(-1).tobytes())
+        self.pending += 1
+
+    def snapshot(self, index: MappedIndex) -> faiss.Index:
+        """Ghi snapshot mới (atomic), bắt đầu WAL rỗng nối tiếp và trả bản mmap của snapshot.
+
+        Chạy được trong thread; caller tự `rebase` trên event loop để search không thấy trạng thái nửa vời.
+        """
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+        faiss.write_index(index.merged(), str(tmp))
+        os.replace(tmp, self.index_path)
+        _atomic_write(self.wal_path, self._wal_header(index.d, index.ntotal))
+        if self.columns is not None:
+            self.columns.save_index(self.meta_index_path)
+        self.pending = 0
+        return self._open_snapshot()
+
+    def save_ann(self, ann: faiss.Index):
+        """Lưu index xấp xỉ (HNSW/IVF-PQ) để lần mở sau không phải train lại."""
+        tmp = self.ann_path.with_name(self.ann_path.name + ".tmp")
+        faiss.write_index(ann, str(tmp))
+        os.replace(tmp, self.ann_path)
+
+    def load_ann(self) -> Optional[faiss.Index]:
+        if not self.ann_path.exists():
+            return None
+        try:
+            return faiss.read_index(str(self.ann_path))
+        except RuntimeError as e:
+            logger.warning(f"Không đọc được index xấp xỉ tại {self.directory}: {e}")
+            return None
+
+    def save_short(self, history: List[Dict], vectors: List[Optional[np.ndarray]], total_messages: int):
+        """Ghi short-term history (vector None lưu thành hàng NaN)."""
+        _atomic_write(
+            self.directory / "short.json",
+            json.dumps({"total_messages": total_messages, "history": history}, ensure_ascii=False).encode("utf-8"),
+        )
+        matrix = np.full((len(vectors), self.dim), np.nan, dtype="float32")
+        for row, vec in enumerate(vectors):
+            if vec is not None and len(vec) == self.dim:
+                matrix[row] = vec
+        tmp = self.directory / "short.npy.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, matrix)
+        os.replace(tmp, self.directory / "short.npy")
+
+    def load_short(self) -> Tuple[List[Dict], List[Optional[np.ndarray]], int]:
+        path = self.directory / "short.json"
+        if not path.exists():
+            return [], [], 0
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            history = data["history"]
+            matrix = np.load(self.directory / "short.npy")
+            vectors = [None if np.isnan(row).any() else row.copy() for row in matrix]
+            if len(vectors) != len(history):
+                vectors = [None] * len(history)
+            return history, vectors, int(data["total_messages"])
+        except Exception as e:
+            logger.warning(f"Không đọc được short-term history tại {self.directory}: {e}")
+            return [], [], 0
@@ -0,0 +1,122 @@
+# app/services/memory_writer.py
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.utils.embed import embed_texts
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from app.services.memory_manager import HybridMemory
+
+
+@dataclass
+class MemoryJob:
+    memory: "HybridMemory"
+    entry: Dict  # Đúng object dict trong short_history (so khớp theo identity)
+    vec: Optional[np.ndarray]  # None -> cần embed
+    position: int  # Vị trí tuyệt đối của message trong conversation (khóa trong HybridMemory._pending)
+
+
+class MemoryWriter:
+    """Writer duy nhất của memory dài hạn.
+
+    `add_message` chỉ cập nhật short-term rồi đẩy job vào queue; task nền gom job thành batch, embed
+    một lần qua /api/embed và là nơi duy nhất ghi FAISS/store, nên request chat không chờ embedding
+    và các request đồng thời không tranh nhau `index.add`.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self._queue: "asyncio.Queue[MemoryJob]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.embedded = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def submit(self, job: MemoryJob) -> bool:
+        """Đưa job vào queue; False nếu writer chưa chạy (caller tự xử lý inline)."""
+        if not self.running:
+            return False
+        self._queue.put_nowait(job)
+        return True
+
+    async def process(self, jobs: List[MemoryJob]):
+        """Embed các job chưa có vector trong một request rồi áp dụng theo thứ tự vào từng memory.
+
+        Dù batch lỗi giữa chừng, mọi job đều được bỏ khỏi danh sách chờ của memory để pending_writes về 0.
+        """
+        try:
+            await self._process(jobs)
+        finally:
+            for job in jobs:
+                job.memory.release_pending([job.position])
+
+    async def _process(self, jobs: List[MemoryJob]):
+        missing = [job for job in jobs if job.vec is None]
+        if missing:
+            started = time.perf_counter()
+            vectors = await embed_texts([job.entry["content"] for job in missing])
+            for job, vec in zip(missing, vectors):
+                job.vec = vec
+            failed = sum(1 for vec in vectors if vec is None)
+            self.embedded += len(missing) - failed
+            self.failed += failed
+            logger.debug(f"Embed batch {len(missing)} message memory trong {time.perf_counter() - started:.3f}s")
+        self.batches += 1
+
+        by_memory: Dict[int, List[MemoryJob]] = {}
+        for job in jobs:
+            by_memory.setdefault(id(job.memory), []).append(job)
+        for memory_jobs in by_memory.values():
+            await memory_jobs[0].memory.apply_vectors([(job.position, job.entry, job.vec) for job in memory_jobs])
+
+    async def _run(self):
+        while True:
+            jobs = [await self._queue.get()]
+            while len(jobs) < self.batch_size and not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+            try:
+                await self.process(jobs)
+            except Exception as e:
+                logger.error(f"Lỗi ghi memory nền ({len(jobs)} message): {e}")
+            finally:
+                for _ in jobs:
+                    self._queue.task_done()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="memory-writer")
+
+    async def stop(self):
+        """Xử lý hết job còn trong queue (không mất message khi tắt server) rồi dừng task."""
+        if self._task is None:
+            return
+        if self._queue.qsize():
+            logger.info(f"Ghi nốt {self._queue.qsize()} message memory trước khi tắt")
+        await self._queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "embedded": self.embedded,
+            "failed": self.failed,
+        }
+
+
+# Khởi tạo singleton instance
+memory_writer = MemoryWriter(batch_size=settings.MEMORY_EMBED_BATCH_SIZE)
+metrics.register("memory_writer", memory_writer.stats)
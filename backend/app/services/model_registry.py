@@ -0,0 +1,160 @@
+# app/services/model_registry.py
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import httpx
+
+from app.config import settings
+from app.services.model_residency import model_residency, normalize_model_name
+from app.services.ollama_client import OllamaClient
+from app.services.ollama_scheduler import Priority
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+
+class ModelRegistry:
+    """Danh sách model có trên Ollama (`/api/tags`), dùng để chọn fallback trước khi gửi request.
+
+    Khi chưa đọc được `/api/tags` (Ollama chưa chạy), mọi model được coi là có sẵn. Model trả 404 lúc chạy
+    bị coi là không có tới lần refresh sau; `post`/`stream` khi đó tự chuyển sang fallback và thử lại một lần.
+    """
+
+    def __init__(self, fallbacks: Dict[str, List[str]], refresh_seconds: float):
+        self.fallbacks = fallbacks
+        self.refresh_seconds = refresh_seconds
+        self._available: Optional[Set[str]] = None
+        self._missing: Set[str] = set()  # Model trả 404 kể từ lần refresh trước
+        self._task: Optional[asyncio.Task] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+        self.warmed: List[str] = []
+
+    def is_available(self, model: str) -> bool:
+        name = normalize_model_name(model)
+        return name not in self._missing and (self._available is None or name in self._available)
+
+    def resolve(self, model: str) -> Optional[str]:
+        """Trả model đầu tiên có sẵn trong chuỗi [model, *fallback], None nếu không có model nào."""
+        for candidate in [model, *self.fallbacks.get(model, [])]:
+            if self.is_available(candidate):
+                if candidate != model:
+                    logger.warning(f"Model {model} không có trên Ollama, dùng fallback {candidate}")
+                return candidate
+        logger.warning(f"Model {model} và các fallback đều không có trên Ollama")
+        return None
+
+    def mark_missing(self, model: str):
+        """Gặp 404 dù registry báo có model -> bỏ model khỏi danh sách tới lần refresh sau."""
+        self._missing.add(normalize_model_name(model))
+
+    def fallback_after_404(self, requested: str, failed: str) -> Optional[str]:
+        """Đánh dấu `failed` không có rồi resolve lại `requested`, None nếu không còn model nào khác để thử."""
+        self.mark_missing(failed)
+        candidate = self.resolve(requested)
+        return candidate if candidate is not None and candidate != failed else None
+
+    async def post(self, path: str, payload: dict, requested: Optional[str] = None, **kwargs) -> dict:
+        """OllamaClient.post với `payload["model"]`; 404 thì thử lại một lần với fallback của `requested`."""
+        model = payload["model"]
+        try:
+            return await OllamaClient.post(path, payload, **kwargs)
+        except httpx.HTTPStatusError as e:
+            retry = self.fallback_after_404(requested or model, model) if e.response.status_code == 404 else None
+            if retry is None:
+                raise
+        logger.warning(f"Model {model} không tồn tại (404), thử lại với {retry}")
+        try:
+            return await OllamaClient.post(path, {**payload, "model": retry}, **kwargs)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                self.mark_missing(retry)
+            raise
+
+    @asynccontextmanager
+    async def stream(
+        self, path: str, payload: dict, requested: Optional[str] = None, **kwargs
+    ) -> AsyncIterator[httpx.Response]:
+        """OllamaClient.stream với `payload["model"]`; 404 lúc mở stream thì mở lại một lần với fallback của
+        `requested` (chưa gửi gì cho client). Caller tự kiểm tra status code như OllamaClient.stream.
+        """
+        model = payload["model"]
+        async with OllamaClient.stream(path, payload, **kwargs) as response:
+            retry = self.fallback_after_404(requested or model, model) if response.status_code == 404 else None
+            if retry is None:
+                yield response
+                return
+        logger.warning(f"Model {model} không tồn tại (404), thử lại với {retry}")
+        async with OllamaClient.stream(path, {**payload, "model": retry}, **kwargs) as response:
+            if response.status_code == 404:
+                self.mark_missing(retry)
+            yield response
+
+    async def refresh(self):
+        data = await OllamaClient.get("/api/tags")
+        self._available = {normalize_model_name(item["name"]) for item in data.get("models", []) if item.get("name")}
+        self._missing.clear()
+        logger.info(f"Model có trên Ollama: {sorted(self._available)}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Không đọc được /api/tags: {e}")
+
+    async def warm_up(self, models: List[str]):
+        """Load sẵn model chính vào RAM/VRAM (request rỗng + keep_alive) để user đầu tiên không chờ load."""
+        for model in models:
+            resolved = self.resolve(model)
+            if resolved is None:
+                continue
+            keep_alive = model_residency.keep_alive_for(resolved) or "5m"
+            try:
+                if resolved == settings.EMBEDDING_MODEL:
+                    payload = {"model": resolved, "input": "", "keep_alive": keep_alive}
+                    await OllamaClient.post("/api/embed", payload, priority=Priority.BACKGROUND)
+                else:
+                    payload = {"model": resolved, "prompt": "", "keep_alive": keep_alive}
+                    await OllamaClient.post("/api/generate", payload, priority=Priority.BACKGROUND)
+                self.warmed.append(resolved)
+                logger.info(f"Đã warm-up model {resolved}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Warm-up model {resolved} thất bại: {e}")
+
+    async def start(self):
+        """Đọc `/api/tags` ngay khi khởi động, sau đó refresh định kỳ và warm-up model nền."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning(f"Không đọc được /api/tags lúc khởi động: {e}")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="model-registry")
+        if settings.MODEL_WARMUP:
+            self._warmup_task = asyncio.create_task(self.warm_up(settings.MODEL_WARMUP), name="model-warmup")
+
+    async def stop(self):
+        tasks = [task for task in (self._task, self._warmup_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._warmup_task = None
+
+    def stats(self) -> dict:
+        return {
+            "available": sorted(self._available) if self._available is not None else None,
+            "missing": sorted(self._missing),
+            "warmed": self.warmed,
+        }
+
+
+# Khởi tạo singleton instance
+model_registry = ModelRegistry(
+    fallbacks=settings.MODEL_FALLBACKS,
+    refresh_seconds=settings.OLLAMA_TAGS_REFRESH_SECONDS,
+)
+metrics.register("model_registry", model_registry.stats)
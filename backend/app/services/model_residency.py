@@ -0,0 +1,131 @@
+# app/services/model_residency.py
+import asyncio
+import re
+import time
+from typing import Dict, List, Optional
+
+from app.config import settings
+from app.services.ollama_scheduler import scheduler
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+_DURATION_RE = re.compile(r"^(-?\d+(?:\.\d+)?)([smh]?)$")
+_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600}
+
+
+def normalize_model_name(name: str) -> str:
+    """Ollama báo tên kèm tag (`4T:latest`), code thường dùng `4T`."""
+    return name if ":" in name else f"{name}:latest"
+
+
+def parse_keep_alive(value) -> float:
+    """Đổi keep_alive của Ollama ("5m", "30s", 300, -1) ra giây; âm nghĩa là giữ mãi."""
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        match = _DURATION_RE.match(str(value).strip())
+        if not match:
+            return 300.0  # Mặc định của Ollama
+        seconds = float(match.group(1)) * _UNITS[match.group(2)]
+    return float("inf") if seconds < 0 else seconds
+
+
+class ModelResidency:
+    """Theo dõi model nào đang nằm trong RAM/VRAM của Ollama để hạn chế swap model.
+
+    - Đọc `/api/ps` định kỳ, cộng thêm model vừa được gọi (Ollama sẽ load nó).
+    - Gắn `keep_alive` theo từng model cho mọi request.
+    - Chọn model tương thích đang warm cho tác vụ phụ (rewrite query, tóm tắt).
+    """
+
+    def __init__(self, keep_alive: Dict[str, str], alternatives: Dict[str, List[str]], refresh_seconds: float):
+        self.keep_alive = {normalize_model_name(k): v for k, v in keep_alive.items()}
+        self.alternatives = alternatives
+        self.refresh_seconds = refresh_seconds
+        self._loaded: Dict[str, float] = {}  # model -> thời điểm dự kiến bị unload (monotonic)
+        self._task: Optional[asyncio.Task] = None
+        self.swaps = 0
+        self.warm_routes = 0
+
+    def keep_alive_for(self, model: str) -> Optional[str]:
+        return self.keep_alive.get(normalize_model_name(model))
+
+    def is_loaded(self, model: Optional[str]) -> bool:
+        if not model:
+            return False
+        expires = self._loaded.get(normalize_model_name(model))
+        return expires is not None and expires > time.monotonic()
+
+    def loaded_models(self) -> List[str]:
+        now = time.monotonic()
+        return [name for name, expires in self._loaded.items() if expires > now]
+
+    def note_used(self, model: Optional[str]):
+        """Ghi nhận model vừa được gửi request (Ollama sẽ load/giữ nó theo keep_alive)."""
+        if not model:
+            return
+        name = normalize_model_name(model)
+        if not self.is_loaded(name):
+            self.swaps += 1
+        self._loaded[name] = time.monotonic() + parse_keep_alive(self.keep_alive.get(name, "5m"))
+
+    def route(self, model: str) -> str:
+        """Trả `model` nếu đang warm, nếu không thì model tương thích đang warm, cuối cùng là chính `model`."""
+        if self.is_loaded(model):
+            return model
+        for alternative in self.alternatives.get(model, []):
+            if self.is_loaded(alternative):
+                self.warm_routes += 1
+                logger.info(f"Model {model} chưa load, dùng model đang warm {alternative}")
+                return alternative
+        return model
+
+    async def refresh(self):
+        """Đồng bộ danh sách model đang load từ `/api/ps`."""
+        from app.services.ollama_client import OllamaClient  # Tránh import vòng
+
+        data = await OllamaClient.get("/api/ps")
+        now = time.monotonic()
+        loaded = {}
+        for item in data.get("models", []):
+            name = normalize_model_name(item.get("name") or item.get("model", ""))
+            # Giữ ước lượng cũ nếu còn hạn, nếu không ước lượng lại theo keep_alive
+            expires = self._loaded.get(name, 0.0)
+            if expires <= now:
+                expires = now + parse_keep_alive(self.keep_alive.get(name, "5m"))
+            loaded[name] = expires
+        self._loaded = loaded
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Không đọc được /api/ps: {e}")
+            await asyncio.sleep(self.refresh_seconds)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="model-residency")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"loaded": self.loaded_models(), "swaps": self.swaps, "warm_routes": self.warm_routes}
+
+
+# Khởi tạo singleton instance
+model_residency = ModelResidency(
+    keep_alive=settings.MODEL_KEEP_ALIVE,
+    alternatives=settings.MODEL_WARM_ALTERNATIVES,
+    refresh_seconds=settings.OLLAMA_PS_REFRESH_SECONDS,
+)
+# Scheduler ưu tiên request tác vụ phụ dùng model đang load để gom theo model
+scheduler.set_affinity(model_residency.is_loaded)
+metrics.register("model_residency", model_residency.stats)
@@ -0,0 +1,153 @@
+# app/services/ollama_client.py
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from app.config import settings
+from app.services.ollama_scheduler import Priority, scheduler
+from app.services.model_residency import model_residency, normalize_model_name
+from app.utils.logger import logger
+
+# Timeout riêng cho từng endpoint của Ollama
+ENDPOINT_TIMEOUTS = {
+    "/api/chat": httpx.Timeout(60.0, read=160.0),
+    "/api/generate": httpx.Timeout(60.0, read=160.0),
+    "/api/embeddings": httpx.Timeout(10.0, read=30.0),
+    "/api/embed": httpx.Timeout(10.0, read=60.0),
+    "/api/tags": httpx.Timeout(5.0),
+    "/api/ps": httpx.Timeout(5.0),
+}
+DEFAULT_TIMEOUT = httpx.Timeout(30.0, read=120.0)
+
+# Endpoint sinh text: gắn num_ctx theo model để runner của Ollama không bị load lại
+GENERATION_ENDPOINTS = {"/api/chat", "/api/generate"}
+
+_NUM_CTX = {normalize_model_name(name): value for name, value in settings.MODEL_NUM_CTX.items()}
+
+# Lớp ưu tiên mặc định theo endpoint; endpoint không có ở đây (tags, ps) không qua scheduler
+ENDPOINT_PRIORITIES = {
+    "/api/chat": Priority.INTERACTIVE,
+    "/api/generate": Priority.INTERACTIVE,
+    "/api/embeddings": Priority.EMBEDDING,
+    "/api/embed": Priority.EMBEDDING,
+}
+
+
+class OllamaClient:
+    """Client Ollama dùng chung toàn process, giữ connection pool keep-alive."""
+    _client: Optional[httpx.AsyncClient] = None
+
+    @classmethod
+    async def start(cls) -> httpx.AsyncClient:
+        """Mở client (gọi trong lifespan của FastAPI)."""
+        if cls._client is None or cls._client.is_closed:
+            cls._client = httpx.AsyncClient(
+                base_url=settings.OLLAMA_BASE_URL,
+                timeout=DEFAULT_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=settings.OLLAMA_KEEPALIVE_EXPIRY,
+                ),
+            )
+            logger.info(f"Đã mở Ollama client tới {settings.OLLAMA_BASE_URL}")
+        return cls._client
+
+    @classmethod
+    async def get_client(cls) -> httpx.AsyncClient:
+        """Lấy client hiện tại, tự mở nếu chưa có (vd: khi chạy ngoài FastAPI)."""
+        if cls._client is None or cls._client.is_closed:
+            return await cls.start()
+        return cls._client
+
+    @classmethod
+    async def close(cls):
+        """Đóng client và giải phóng connection pool."""
+        if cls._client is not None and not cls._client.is_closed:
+            await cls._client.aclose()
+            logger.info("Đã đóng Ollama client")
+        cls._client = None
+
+    @staticmethod
+    def num_ctx_for(model: str) -> int:
+        """Cửa sổ context (token) của model khi gọi qua client này."""
+        return _NUM_CTX.get(normalize_model_name(model), settings.OLLAMA_DEFAULT_NUM_CTX)
+
+    @staticmethod
+    def _timeout(path: str, timeout: Optional[httpx.Timeout]) -> httpx.Timeout:
+        return timeout or ENDPOINT_TIMEOUTS.get(path, DEFAULT_TIMEOUT)
+
+    @staticmethod
+    @asynccontextmanager
+    async def _slot(path: str, payload: dict, priority: Optional[Priority]) -> AsyncIterator[None]:
+        """Xin slot từ scheduler cho request (raise SchedulerOverloaded nếu quá tải)."""
+        priority = priority if priority is not None else ENDPOINT_PRIORITIES.get(path)
+        if priority is None:
+            yield
+            return
+        model = payload.get("model")
+        async with scheduler.slot(priority, model):
+            if model:
+                # keep_alive theo từng model để model hay dùng không bị unload
+                keep_alive = model_residency.keep_alive_for(model)
+                if keep_alive is not None:
+                    payload.setdefault("keep_alive", keep_alive)
+                num_ctx = _NUM_CTX.get(normalize_model_name(model))
+                if num_ctx is not None and path in GENERATION_ENDPOINTS:
+                    payload.setdefault("options", {}).setdefault("num_ctx", num_ctx)
+                model_residency.note_used(model)
+            yield
+
+    @classmethod
+    async def get(cls, path: str, timeout: Optional[httpx.Timeout] = None) -> dict:
+        """GET endpoint không streaming, trả JSON."""
+        client = await cls.get_client()
+        response = await client.get(path, timeout=cls._timeout(path, timeout))
+        response.raise_for_status()
+        return response.json()
+
+    @classmethod
+    async def post(
+        cls,
+        path: str,
+        payload: dict,
+        timeout: Optional[httpx.Timeout] = None,
+        priority: Optional[Priority] = None,
+    ) -> dict:
+        """POST endpoint không streaming, trả JSON."""
+        client = await cls.get_client()
+        async with cls._slot(path, payload, priority):
+            response = await client.post(path, json=payload, timeout=cls._timeout(path, timeout))
+        response.raise_for_status()
+        return response.json()
+
+    @classmethod
+    @asynccontextmanager
+    async def stream(
+        cls,
+        path: str,
+        payload: dict,
+        timeout: Optional[httpx.Timeout] = None,
+        priority: Optional[Priority] = None,
+    ) -> AsyncIterator[httpx.Response]:
+        """Mở response streaming (giữ slot scheduler tới khi đóng stream), caller tự kiểm tra status code."""
+        client = await cls.get_client()
+        async with cls._slot(path, payload, priority):
+            async with client.stream("POST", path, json=payload, timeout=cls._timeout(path, timeout)) as response:
+                yield response
+
+    @classmethod
+    async def stream_lines(
+        cls,
+        path: str,
+        payload: dict,
+        timeout: Optional[httpx.Timeout] = None,
+        priority: Optional[Priority] = None,
+    ) -> AsyncIterator[str]:
+        """Stream từng dòng NDJSON không rỗng, raise HTTPStatusError nếu lỗi."""
+        async with cls.stream(path, payload, timeout, priority) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield line
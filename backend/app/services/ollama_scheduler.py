@@ -0,0 +1,212 @@
+# app/services/ollama_scheduler.py
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import AsyncIterator, Callable, Deque, Dict, Optional
+
+from app.config import settings
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+
+class Priority(IntEnum):
+    """Lớp ưu tiên của request tới Ollama (số nhỏ được phục vụ trước)."""
+    INTERACTIVE = 0  # Sinh câu trả lời / mô tả ảnh / rewrite query trong request của user
+    EMBEDDING = 1    # Embedding cho memory, rerank
+    BACKGROUND = 2   # Tóm tắt nền (search summary, summarize_history)
+
+
+class SchedulerOverloaded(Exception):
+    """Ollama đang quá tải: hàng đợi đầy hoặc chờ quá lâu."""
+
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    model: Optional[str]
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class _ClassStats:
+    admitted: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+class OllamaScheduler:
+    """Điều phối mọi request tới Ollama: giới hạn đồng thời theo lớp, hàng đợi ưu tiên, từ chối sớm khi quá tải."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        class_limits: Dict[Priority, int],
+        max_queue: Dict[Priority, int],
+        max_wait: Dict[Priority, float],
+        affinity_max_skip_wait: float = 2.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.class_limits = class_limits
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._active: Dict[Priority, int] = {p: 0 for p in Priority}
+        self._queues: Dict[Priority, Deque[_Waiter]] = {p: deque() for p in Priority}
+        self._stats: Dict[Priority, _ClassStats] = {p: _ClassStats() for p in Priority}
+        self.affinity_max_skip_wait = affinity_max_skip_wait
+        self._is_resident: Optional[Callable[[Optional[str]], bool]] = None
+        self.affinity_hits = 0
+
+    def set_affinity(self, is_resident: Callable[[Optional[str]], bool]):
+        """Đặt hàm kiểm tra model đang load; tác vụ phụ dùng model đó được ưu tiên trong cùng lớp."""
+        self._is_resident = is_resident
+
+    @property
+    def total_active(self) -> int:
+        return sum(self._active.values())
+
+    def _has_capacity(self, priority: Priority) -> bool:
+        return self.total_active < self.max_concurrency and self._active[priority] < self.class_limits[priority]
+
+    def _higher_waiting(self, priority: Priority) -> bool:
+        """Có waiter lớp cao hơn (hoặc cùng lớp) đang chờ và lấy được slot ngay.
+
+        Waiter chỉ bị chặn bởi giới hạn của lớp nó không giữ slot toàn cục, lớp thấp hơn vẫn được vào.
+        """
+        return any(self._queues[p] and self._has_capacity(p) for p in Priority if p <= priority)
+
+    def is_overloaded(self, priority: Priority) -> bool:
+        """Hàng đợi của lớp đã đầy, request mới sẽ bị từ chối ngay."""
+        return len(self._queues[priority]) >= self.max_queue[priority]
+
+    def _grant(self, priority: Priority, waited: float):
+        self._active[priority] += 1
+        stats = self._stats[priority]
+        stats.admitted += 1
+        stats.total_wait += waited
+        stats.max_wait = max(stats.max_wait, waited)
+
+    def _next_waiter(self, priority: Priority) -> _Waiter:
+        """Lấy waiter kế tiếp; với tác vụ phụ, ưu tiên waiter dùng model đang load (tránh swap model)."""
+        queue = self._queues[priority]
+        head = queue[0]
+        if (
+            priority != Priority.INTERACTIVE
+            and self._is_resident is not None
+            and not self._is_resident(head.model)
+            # Không để waiter đầu hàng bị vượt quá lâu
+            and time.monotonic() - head.enqueued_at < self.affinity_max_skip_wait
+        ):
+            for waiter in queue:
+                if not waiter.future.done() and self._is_resident(waiter.model):
+                    queue.remove(waiter)
+                    self.affinity_hits += 1
+                    return waiter
+        return queue.popleft()
+
+    def _dispatch(self):
+        """Cấp slot trống cho waiter theo thứ tự ưu tiên."""
+        for priority in Priority:
+            queue = self._queues[priority]
+            while queue and self._has_capacity(priority):
+                waiter = self._next_waiter(priority)
+                if waiter.future.done():  # Waiter đã hủy / timeout
+                    continue
+                self._grant(priority, time.monotonic() - waiter.enqueued_at)
+                waiter.future.set_result(None)
+
+    async def acquire(self, priority: Priority, model: Optional[str] = None):
+        """Chờ tới lượt; raise SchedulerOverloaded nếu hàng đợi đầy hoặc chờ quá max_wait."""
+        if not self._higher_waiting(priority) and self._has_capacity(priority):
+            self._grant(priority, 0.0)
+            return
+
+        if self.is_overloaded(priority):
+            self._stats[priority].rejected += 1
+            logger.warning(f"Từ chối request {priority.name} ({model}): hàng đợi đầy")
+            raise SchedulerOverloaded(f"Hàng đợi {priority.name} đã đầy")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), model)
+        self._queues[priority].append(waiter)
+        self._dispatch()  # Slot có thể đang trống (waiter phía trước bị chặn bởi giới hạn lớp của nó)
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.max_wait[priority])
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Đã được cấp slot đúng lúc bị hủy -> trả lại slot
+                self.release(priority)
+            else:
+                try:
+                    self._queues[priority].remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats[priority].timed_out += 1
+                logger.warning(f"Request {priority.name} ({model}) chờ quá {self.max_wait[priority]}s, từ chối")
+                raise SchedulerOverloaded(f"Chờ slot {priority.name} quá lâu") from None
+            raise
+
+    def release(self, priority: Priority):
+        self._active[priority] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority, model: Optional[str] = None) -> AsyncIterator[None]:
+        """Giữ một slot trong suốt thời gian gọi Ollama (kể cả streaming)."""
+        await self.acquire(priority, model)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict:
+        """Số liệu hàng đợi cho /api/metrics."""
+        now = time.monotonic()
+        classes = {}
+        for priority in Priority:
+            stats = self._stats[priority]
+            queue = self._queues[priority]
+            classes[priority.name.lower()] = {
+                "active": self._active[priority],
+                "limit": self.class_limits[priority],
+                "queued": len(queue),
+                "oldest_wait_ms": round((now - queue[0].enqueued_at) * 1000, 1) if queue else 0.0,
+                "admitted": stats.admitted,
+                "rejected": stats.rejected,
+                "timed_out": stats.timed_out,
+                "avg_wait_ms": round(stats.total_wait / stats.admitted * 1000, 1) if stats.admitted else 0.0,
+                "max_wait_ms": round(stats.max_wait * 1000, 1),
+            }
+        return {
+            "active": self.total_active,
+            "max_concurrency": self.max_concurrency,
+            "affinity_hits": self.affinity_hits,
+            "classes": classes,
+        }
+
+
+# Khởi tạo singleton instance
+scheduler = OllamaScheduler(
+    max_concurrency=settings.OLLAMA_MAX_CONCURRENCY,
+    class_limits={
+        Priority.INTERACTIVE: settings.OLLAMA_INTERACTIVE_LIMIT,
+        Priority.EMBEDDING: settings.OLLAMA_EMBEDDING_LIMIT,
+        Priority.BACKGROUND: settings.OLLAMA_BACKGROUND_LIMIT,
+    },
+    max_queue={
+        Priority.INTERACTIVE: settings.OLLAMA_INTERACTIVE_MAX_QUEUE,
+        Priority.EMBEDDING: settings.OLLAMA_EMBEDDING_MAX_QUEUE,
+        Priority.BACKGROUND: settings.OLLAMA_BACKGROUND_MAX_QUEUE,
+    },
+    max_wait={
+        Priority.INTERACTIVE: settings.OLLAMA_INTERACTIVE_MAX_WAIT,
+        Priority.EMBEDDING: settings.OLLAMA_EMBEDDING_MAX_WAIT,
+        Priority.BACKGROUND: settings.OLLAMA_BACKGROUND_MAX_WAIT,
+    },
+    affinity_max_skip_wait=settings.OLLAMA_AFFINITY_MAX_SKIP_WAIT,
+)
+metrics.register("ollama_scheduler", scheduler.stats)
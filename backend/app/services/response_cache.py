@@ -0,0 +1,139 @@
+# app/services/response_cache.py
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from app.config import settings
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+Event = Union[bytes, str]
+
+_QUANT_SCALE = 127.0
+_TRAILING_PUNCT_RE = re.compile(r"[\s?!.,;:…]+$")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Chuẩn hóa prompt để so khớp: NFKC, chữ thường, gộp khoảng trắng, bỏ dấu câu cuối."""
+    text = unicodedata.normalize("NFKC", prompt).lower()
+    text = _SPACES_RE.sub(" ", text).strip()
+    return _TRAILING_PUNCT_RE.sub("", text)
+
+
+def quantize(vec: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa L2 rồi lượng tử hóa int8 (4 lần nhỏ hơn float32, cosine sai lệch < 1%)."""
+    norm = np.linalg.norm(vec)
+    if norm == 0:
+        return np.zeros(vec.shape, dtype=np.int8)
+    return np.clip(np.rint(vec / norm * _QUANT_SCALE), -127, 127).astype(np.int8)
+
+
+@dataclass
+class CachedResponse:
+    namespace: str
+    normalized: str
+    vector: Optional[np.ndarray]
+    events: List[Event]  # Các dòng NDJSON đã gửi client (sources, content_start, chunk Ollama)
+    answer: str  # Nội dung trả lời đầy đủ, để ghi vào memory khi phát lại
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class ResponseCache:
+    """Cache câu trả lời cho prompt lặp lại / gần giống (chào hỏi, câu hỏi FAQ).
+
+    - Khớp chính xác theo prompt chuẩn hóa, nếu không thì theo cosine của embedding int8 >= threshold.
+    - `namespace` tách câu trả lời theo model và chế độ (vd: thinking); prompt phụ thuộc history thêm
+      conversation_id vào namespace để không dùng lẫn giữa các conversation.
+    - Lưu nguyên các dòng NDJSON đã gửi client để phát lại y hệt.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries: "OrderedDict[Tuple[str, str], CachedResponse]" = OrderedDict()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def _expired(self, entry: CachedResponse, now: float) -> bool:
+        return now - entry.created_at > self.ttl_seconds
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if self._expired(entry, now)]:
+            del self._entries[key]
+
+    def lookup(self, prompt: str, vec: Optional[np.ndarray], namespace: str = "default") -> Optional[CachedResponse]:
+        """Trả câu trả lời đã lưu nếu có prompt giống, None nếu miss."""
+        self._purge_expired()
+        normalized = normalize_prompt(prompt)
+        key = (namespace, normalized)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            logger.info(f"Response cache hit (chính xác): {normalized[:50]}")
+            return entry
+
+        candidates = [
+            (k, e) for k, e in self._entries.items() if e.namespace == namespace and e.vector is not None
+        ]
+        if vec is not None and candidates:
+            query = quantize(vec).astype(np.int32)
+            matrix = np.stack([e.vector for _, e in candidates]).astype(np.int32)
+            similarity = (matrix @ query) / (_QUANT_SCALE * _QUANT_SCALE)
+            best = int(np.argmax(similarity))
+            if similarity[best] >= self.threshold:
+                best_key, best_entry = candidates[best]
+                self._entries.move_to_end(best_key)
+                self.semantic_hits += 1
+                logger.info(
+                    f"Response cache hit (cosine={similarity[best]:.3f}): {normalized[:50]} ~ {best_entry.normalized[:50]}"
+                )
+                return best_entry
+
+        self.misses += 1
+        return None
+
+    def store(self, prompt: str, vec: Optional[np.ndarray], events: List[Event], answer: str, namespace: str = "default"):
+        """Lưu câu trả lời vừa stream xong, evict LRU khi vượt max_entries."""
+        normalized = normalize_prompt(prompt)
+        key = (namespace, normalized)
+        self._entries[key] = CachedResponse(
+            namespace, normalized, quantize(vec) if vec is not None else None, list(events), answer
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def note_bypass(self):
+        self.bypassed += 1
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "enabled": settings.RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Khởi tạo singleton instance
+response_cache = ResponseCache(
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+    threshold=settings.RESPONSE_CACHE_SIMILARITY,
+)
+metrics.register("response_cache", response_cache.stats)
@@ -1,11 +1,15 @@
+# app/services/summarize_history.py
+from app.services.ollama_scheduler import Priority
+from app.services.model_residency import model_residency
+from app.services.model_registry import model_registry
+from app.utils.logger import logger
 
-OLLAMA_API_URL = "http://localhost:11434/api"
 brief_history_model = "4T-S"
 history = []  # Danh sách lưu lịch sử hội thoại
 
-async def summarize_history(session, past_conversations: list, prompt: str) -> str:
+async def summarize_history(past_conversations: list, prompt: str = "") -> str:
 
-    """Tóm tắt lịch sử hội thoại sử dụng LLM."""
+    """Tóm tắt lịch sử hội thoại sử dụng LLM (prompt rỗng: tóm tắt chung, không theo chủ đề)."""
     if not past_conversations:
         return ""
 
@@ -13,31 +17,33 @@ async def summarize_history(session, past_conversations: list, prompt: str) -> s
     history_str = "\n\n".join([
         f"[{msg['role'].capitalize()}]: {msg['content']}"
         for msg in past_messages_flat
-        if msg["role"] in ["user", "assistant"]
+        if msg["role"] in ["user", "assistant", "summary"]
     ])
+    focus = f", liên quan đến `{prompt}`" if prompt else ""
 
     summary_prompt = f"""
-    Tóm tắt lịch sử hội thoại sau bằng tiếng Việt, liên quan đến `{prompt}`:
+    Tóm tắt lịch sử hội thoại sau bằng tiếng Việt{focus}:
     {history_str}
     Giữ thông tin cần thiết, ý chính trong history. Chỉ cần trả ra tóm tắt. Không thêm bất kì thông tin nào khác.
     """
 
+    requested_model = model_residency.route(brief_history_model)
+    summary_model = model_registry.resolve(requested_model)
+    if summary_model is None:
+        return ""
+
     payload = {
-        "model": brief_history_model,
+        "model": summary_model,
         "messages": [{"role": "user", "content": summary_prompt}],
         "stream": False,
         "options": {"temperature": 0.35, "num_predict": -1}
     }
 
     try:
-        async with session.post(f"{OLLAMA_API_URL}/chat", json=payload) as response:
-            if response.status == 200:
-                data = await response.json()
-                summary = data.get("message", {}).get("content", "").strip()
-
-                return summary
-            else:
-                return ""
+        data = await model_registry.post("/api/chat", payload, requested=requested_model, priority=Priority.BACKGROUND)
+        summary = data.get("message", {}).get("content", "").strip()
+        return summary
     except Exception as e:
+        logger.error(f"Lỗi tóm tắt lịch sử: {e}")
         return ""
 
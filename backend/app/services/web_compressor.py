@@ -0,0 +1,90 @@
+# app/services/web_compressor.py
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app.services.context_builder import estimate_tokens
+from app.utils.bm25 import BM25Index, tokenize
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?。])\s+|\n+")
+PASSAGE_SEPARATOR = " … "
+
+
+def split_passages(text: str, max_chars: int) -> List[str]:
+    """Tách trang thành đoạn ngắn: gom các câu liên tiếp tới khoảng `max_chars` ký tự."""
+    passages, current = [], ""
+    for sentence in _SENTENCE_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) > max_chars:
+            # Câu quá dài (bảng, code, text không dấu câu): cắt cứng
+            if current:
+                passages.append(current)
+                current = ""
+            passages.extend(sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars))
+            continue
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            passages.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        passages.append(current)
+    return passages
+
+
+def compress_results(results: List[Dict], query: str, source_tokens: int) -> List[Dict]:
+    """Giữ các đoạn liên quan nhất tới `query` của mỗi nguồn (BM25), tối đa `source_tokens` token/nguồn.
+
+    Đoạn được giữ theo thứ tự xuất hiện trong trang để đọc liền mạch; URL/title giữ nguyên.
+    """
+    index = BM25Index()
+    owners: List[Tuple[int, int]] = []  # doc id -> (vị trí nguồn, vị trí đoạn trong nguồn)
+    passages_by_source: List[List[str]] = []
+    for source_idx, item in enumerate(results):
+        passages = split_passages(item.get("content", ""), settings.WEB_PASSAGE_MAX_CHARS)
+        passages_by_source.append(passages)
+        for passage_idx, passage in enumerate(passages):
+            index.add(tokenize(passage))
+            owners.append((source_idx, passage_idx))
+
+    # IDF tính trên đoạn của mọi nguồn nên term xuất hiện khắp nơi (menu, footer) ít điểm
+    scores = index.scores(tokenize(query))
+    scores_by_source: List[List[float]] = [[] for _ in results]
+    for (source_idx, _), score in zip(owners, scores.tolist()):
+        scores_by_source[source_idx].append(score)
+
+    tokens_before = tokens_after = 0
+    compressed = []
+    for item, passages, source_scores in zip(results, passages_by_source, scores_by_source):
+        content = item.get("content", "")
+        tokens_before += estimate_tokens(content)
+        source_scores = np.asarray(source_scores, dtype=np.float32)
+        # Chỉ lấy đoạn có khớp query; trang không có đoạn nào khớp thì lấy các đoạn đầu trang
+        order = np.argsort(-source_scores, kind="stable")
+        if source_scores.size and source_scores.max() > 0:
+            order = order[source_scores[order] > 0]
+        kept, used = [], 0
+        for passage_idx in order.tolist():
+            cost = estimate_tokens(passages[passage_idx])
+            if used + cost > source_tokens:
+                continue
+            kept.append(passage_idx)
+            used += cost
+        text = PASSAGE_SEPARATOR.join(passages[i] for i in sorted(kept))
+        tokens_after += estimate_tokens(text)
+        compressed.append({**item, "content": text})
+
+    metrics.inc("web_context_tokens_in", tokens_before)
+    metrics.inc("web_context_tokens_out", tokens_after)
+    if tokens_before:
+        logger.info(
+            f"Nén web_context: ~{tokens_before} -> ~{tokens_after} token "
+            f"(-{1 - tokens_after / tokens_before:.0%}) trên {len(results)} nguồn"
+        )
+    return compressed
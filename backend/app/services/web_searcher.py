@@ -6,26 +6,30 @@ from typing import List, Dict, Literal, Optional
 from app.services.search_cache import search_cache
 from app.services.web_crawler import crawl_urls
 from app.services.session_manager import SessionManager
+from app.services.ollama_scheduler import Priority
+from app.services.model_residency import model_residency
+from app.services.model_registry import model_registry
 from app.utils.logger import logger
 
 from ddgs import DDGS
 from app.utils.embed import embed_text  # Import hàm chung từ utils.embed
 
 OLLAMA_SUMMARY_MODEL = "4T-S"
-OLLAMA_API_URL = "http://localhost:11434/api"
 
 async def summarize_text(text: str, query: str) -> str:
+    requested_model = model_residency.route(OLLAMA_SUMMARY_MODEL)
+    summary_model = model_registry.resolve(requested_model)
+    if summary_model is None:
+        return text[:500]
     try:
-        session = await SessionManager.get_session()
         prompt = f"Tóm tắt ngắn gọn (<=5 câu) nội dung sau, tập trung vào: {query}\n\n{text}"
         payload = {
-            "model": OLLAMA_SUMMARY_MODEL,
+            "model": summary_model,
             "prompt": prompt,
             "stream": False,
         }
-        async with session.post(f"{OLLAMA_API_URL}/generate", json=payload) as resp:
-            data = await resp.json()
-            return data.get("response", "").strip()
+        data = await model_registry.post("/api/generate", payload, requested=requested_model, priority=Priority.BACKGROUND)
+        return data.get("response", "").strip()
     except Exception as e:
         logger.error(f"Lỗi summarize: {e}")
         return text[:500]
@@ -87,13 +91,16 @@ async def search_web(
             results = crawled
 
         elif mode == "rerank":
-            qvec = await embed_text(query)
+            # Gọi đồng thời: embedding_batcher gom query + mọi trang thành một request /api/embed
+            qvec, *vectors = await asyncio.gather(
+                embed_text(query),
+                *(embed_text(item["title"] + " " + item["content"][:500]) for item in crawled),
+            )
             if qvec is None:
                 results = crawled
             else:
                 scored = []
-                for item in crawled:
-                    vec = await embed_text(item["title"] + " " + item["content"][:500])
+                for item, vec in zip(crawled, vectors):
                     if vec is not None:
                         score = cosine_similarity(qvec, vec)
                         scored.append((score, item))
@@ -0,0 +1,86 @@
+# app/utils/bm25.py
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Tách từ đơn giản (chữ thường, theo \\w của Unicode): đủ cho tiếng Việt theo âm tiết và tiếng Anh."""
+    return _WORD_RE.findall(text.lower())
+
+
+class _Posting:
+    """Posting list của một term: mảng numpy tăng gấp đôi khi đầy, thêm doc không phải dựng lại."""
+
+    __slots__ = ("ids", "tfs", "size")
+
+    def __init__(self):
+        self.ids = np.empty(4, dtype=np.int64)
+        self.tfs = np.empty(4, dtype=np.float32)
+        self.size = 0
+
+    def append(self, doc_id: int, tf: int):
+        if self.size == len(self.ids):
+            self.ids = np.resize(self.ids, 2 * self.size)
+            self.tfs = np.resize(self.tfs, 2 * self.size)
+        self.ids[self.size] = doc_id
+        self.tfs[self.size] = tf
+        self.size += 1
+
+
+class BM25Index:
+    """BM25 (Okapi) với inverted index, thêm document tăng dần.
+
+    Posting và độ dài document là mảng numpy ghi thêm tại chỗ (không bị xóa cache sau mỗi `add`),
+    nên query ngay sau khi thêm vẫn nhanh. Chấm điểm chỉ duyệt posting của các term trong query.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, _Posting] = {}
+        self._lengths = np.empty(16, dtype=np.float32)
+        self._size = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, tokens: Iterable[str]) -> int:
+        """Thêm một document, trả doc id (thứ tự thêm)."""
+        doc_id = self._size
+        counts = Counter(tokens)
+        length = sum(counts.values())
+        for term, tf in counts.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = _Posting()
+            posting.append(doc_id, tf)
+        if self._size == len(self._lengths):
+            self._lengths = np.resize(self._lengths, 2 * self._size)
+        self._lengths[doc_id] = length
+        self._size += 1
+        self._total_length += length
+        return doc_id
+
+    def scores(self, query_tokens: Iterable[str]) -> np.ndarray:
+        """Điểm BM25 của mọi document với query (0 nếu không chứa term nào)."""
+        n = self._size
+        scores = np.zeros(n, dtype=np.float32)
+        if n == 0:
+            return scores
+        avg_length = self._total_length / n or 1.0
+        for term in set(query_tokens):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting.ids[: posting.size], posting.tfs[: posting.size]
+            idf = math.log(1 + (n - posting.size + 0.5) / (posting.size + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[ids] / avg_length)
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        return scores
@@ -0,0 +1,75 @@
+# app/utils/disconnect.py
+import asyncio
+from typing import AsyncIterator, Union
+
+from starlette.requests import Request
+
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+Chunk = Union[bytes, str]
+_END = object()
+
+
+async def stream_until_disconnect(
+    http_request: Request,
+    body: AsyncIterator[Chunk],
+    poll_interval: float = 0.5,
+    buffer_size: int = 64,
+) -> AsyncIterator[Chunk]:
+    """Chạy `body` trong task riêng và hủy task đó ngay khi client ngắt kết nối.
+
+    Không phụ thuộc việc server phát hiện lỗi ở lần gửi chunk kế tiếp: generator
+    bên trong nhận CancelledError ở đúng chỗ đang chờ (stream Ollama, crawl, embedding)
+    và tự dọn dẹp trong `finally`.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+
+    async def pump():
+        try:
+            async for chunk in body:
+                await queue.put(chunk)
+        finally:
+            await body.aclose()
+        await queue.put(_END)
+
+    producer = asyncio.create_task(pump(), name="chat-stream")
+
+    async def watch():
+        while not producer.done():
+            if await http_request.is_disconnected():
+                logger.info("Client đã ngắt kết nối, hủy xử lý request")
+                producer.cancel()
+                return
+            await asyncio.sleep(poll_interval)
+
+    watcher = asyncio.create_task(watch(), name="chat-disconnect-watch")
+    completed = False
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            # Producer lỗi/bị hủy thì không còn ai đẩy _END vào queue
+            await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            chunk = getter.result()
+            if chunk is _END:
+                break
+            yield chunk
+        # Chunk còn lại trong queue khi producer kết thúc
+        while not queue.empty():
+            chunk = queue.get_nowait()
+            if chunk is not _END:
+                yield chunk
+        completed = not producer.cancelled()
+        if producer.done() and completed and producer.exception() is not None:
+            raise producer.exception()
+    finally:
+        if not completed:
+            metrics.inc("client_disconnects")
+        watcher.cancel()
+        if not producer.done():
+            # Response bị bỏ dở (server phát hiện client ngắt khi gửi) -> dừng luôn phần xử lý phía sau
+            producer.cancel()
+        await asyncio.gather(producer, watcher, return_exceptions=True)
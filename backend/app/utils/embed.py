@@ -1,17 +1,59 @@
 # app/utils/embed.py
+import asyncio
+from typing import List
+
 import numpy as np
-from app.services.session_manager import SessionManager
+from app.config import settings
+from app.services.embedding_batcher import embedding_batcher
+from app.services.embedding_cache import embedding_cache, embedding_key
 from app.utils.logger import logger
 
+def truncate_embedding(vec: np.ndarray, dim: int) -> np.ndarray:
+    """Cắt Matryoshka: giữ `dim` chiều đầu rồi chuẩn hóa L2 lại (dim <= 0 hoặc vector đã đủ ngắn: giữ nguyên)."""
+    if dim <= 0 or len(vec) <= dim:
+        return vec
+    head = vec[:dim]
+    return head / max(float(np.linalg.norm(head)), 1e-12)
+
 async def embed_text(text: str) -> np.ndarray | None:
-    """Embed text dùng Ollama /api/embeddings, trả np.ndarray hoặc None nếu lỗi."""
-    try:
-        session = await SessionManager.get_session()
-        payload = {"model": "embeddinggemma:latest", "prompt": text}
-        async with session.post("http://localhost:11434/api/embeddings", json=payload) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            return np.array(data["embedding"], dtype="float32")
-    except Exception as e:
-        logger.error(f"Lỗi embed text: {e}")
+    """Embed text qua embedding_cache rồi embedding_batcher (/api/embed), trả np.ndarray hoặc None nếu lỗi.
+
+    Cache giữ vector đầy đủ; vector trả ra đã cắt theo EMBED_TRUNCATE_DIM.
+    """
+    key = embedding_key(settings.EMBEDDING_MODEL, text)
+    vector = await embedding_cache.get(key)
+    if vector is None:
+        vector = await embedding_batcher.embed(text)
+        if vector is None:
+            return None
+        embedding_cache.put(key, vector)
+    return truncate_embedding(vector, settings.EMBED_TRUNCATE_DIM)
+
+async def embed_texts(texts: List[str]) -> List[np.ndarray | None]:
+    """Embed nhiều text: text chưa có trong cache gửi đồng thời qua embedding_batcher (gom thành batch /api/embed).
+
+    Text embed lỗi trả None.
+    """
+    if not texts:
+        return []
+    keys = [embedding_key(settings.EMBEDDING_MODEL, text) for text in texts]
+    vectors: List[np.ndarray | None] = await embedding_cache.get_many(keys)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    embedded = await asyncio.gather(*(embedding_batcher.embed(texts[i]) for i in missing))
+    for i, vector in zip(missing, embedded):
+        if vector is not None:
+            vectors[i] = vector
+            embedding_cache.put(keys[i], vector)
+    return [truncate_embedding(vector, settings.EMBED_TRUNCATE_DIM) if vector is not None else None for vector in vectors]
+
+async def detect_embedding_dim() -> int | None:
+    """Số chiều embedding dùng cho memory/rerank (sau EMBED_TRUNCATE_DIM), đo bằng một lần embed lúc khởi động."""
+    vector = await embedding_batcher.embed("dimension probe")
+    if vector is None:
         return None
+    dim = len(truncate_embedding(vector, settings.EMBED_TRUNCATE_DIM))
+    if dim < len(vector):
+        logger.info(f"Embedding {settings.EMBEDDING_MODEL}: {len(vector)} chiều, cắt Matryoshka còn {dim}")
+    else:
+        logger.info(f"Embedding {settings.EMBEDDING_MODEL}: {dim} chiều")
+    return dim
@@ -0,0 +1,129 @@
+# app/utils/image_preprocess.py
+import asyncio
+import base64
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from app.config import settings
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+# Decode/resize/encode ảnh là việc CPU, chạy trong pool riêng để không chặn event loop
+_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_PREPROCESS_WORKERS, thread_name_prefix="image-preprocess")
+
+FINGERPRINT_SIZE = (256, 256)
+
+_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "pixels_in": 0, "pixels_out": 0, "total_ms": 0.0, "failed": 0}
+
+
+@dataclass
+class PreprocessedImage:
+    base64: str
+    phash: Optional[int] = None  # dHash 256 bit, None nếu không decode được ảnh
+    fingerprint: Optional[np.ndarray] = None  # Ảnh xám 256x256 để xác nhận hai ảnh thật sự giống nhau
+
+
+def dhash(img: Image.Image, hash_size: int = 16) -> int:
+    """Perceptual hash (dHash hash_size² bit): so độ sáng các pixel kề nhau trên ảnh xám thu nhỏ.
+
+    Ảnh giống nhau (encode lại, resize, lệch vài pixel) cho hash chỉ khác vài bit.
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _preprocess(image_bytes: bytes) -> Tuple[bytes, dict]:
+    """Decode một lần, thu nhỏ về độ phân giải model vision dùng, encode JPEG không metadata."""
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        original_size = img.size
+        # JPEG: decode thẳng ở tỉ lệ nhỏ hơn (DCT scaling), các định dạng khác bỏ qua
+        img.draft("RGB", (settings.IMAGE_MAX_SIDE, settings.IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)  # Áp dụng hướng xoay từ EXIF trước khi bỏ metadata
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # Vision model không dùng alpha: ghép lên nền trắng
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        # Ảnh lớn hơn thì encoder của model vision cũng resize xuống, gửi bản gốc chỉ tốn băng thông
+        img.thumbnail((settings.IMAGE_MAX_SIDE, settings.IMAGE_MAX_SIDE), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=settings.IMAGE_JPEG_QUALITY, optimize=True)  # Không truyền exif/icc -> bỏ metadata
+        info = {
+            "original_size": original_size,
+            "size": img.size,
+            "phash": dhash(img),
+            "fingerprint": np.asarray(img.convert("L").resize(FINGERPRINT_SIZE, Image.BOX), dtype=np.uint8),
+            "elapsed_ms": (time.perf_counter() - started) * 1000,
+        }
+    return out.getvalue(), info
+
+
+def _reencode_plain(image_bytes: bytes) -> bytes:
+    """Encode lại pixel đã decode, không xoay/resize (dùng khi _preprocess lỗi, vd EXIF hỏng), không metadata."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=settings.IMAGE_JPEG_QUALITY)
+    return out.getvalue()
+
+
+async def preprocess_image(image_bytes: bytes) -> Optional[PreprocessedImage]:
+    """Tiền xử lý ảnh và tính perceptual hash; None nếu không decode được ảnh.
+
+    Không bao giờ gửi bytes gốc cho model vision (có thể chứa EXIF/GPS): khi tiền xử lý lỗi thì encode lại
+    pixel không kèm metadata (không có hash), encode lại cũng lỗi thì bỏ ảnh.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        processed, info = await loop.run_in_executor(_executor, _preprocess, image_bytes)
+    except Exception as e:
+        _stats["failed"] += 1
+        try:
+            plain = await loop.run_in_executor(_executor, _reencode_plain, image_bytes)
+        except Exception:
+            logger.warning(f"Không decode được ảnh, bỏ qua ảnh: {e}")
+            return None
+        logger.warning(f"Không tiền xử lý được ảnh, gửi bản encode lại không metadata: {e}")
+        return PreprocessedImage(base64.b64encode(plain).decode("ascii"))
+
+    (w0, h0), (w1, h1) = info["original_size"], info["size"]
+    _stats["images"] += 1
+    _stats["bytes_in"] += len(image_bytes)
+    _stats["bytes_out"] += len(processed)
+    _stats["pixels_in"] += w0 * h0
+    _stats["pixels_out"] += w1 * h1
+    _stats["total_ms"] += info["elapsed_ms"]
+    saved = 1 - len(processed) / len(image_bytes) if image_bytes else 0.0
+    logger.info(
+        f"Tiền xử lý ảnh: {w0}x{h0} -> {w1}x{h1}, {len(image_bytes) / 1024:.0f}KB -> {len(processed) / 1024:.0f}KB "
+        f"(-{saved:.0%}, base64 -{(len(image_bytes) - len(processed)) * 4 / 3 / 1024:.0f}KB), "
+        f"pixel cho vision encoder -{1 - (w1 * h1) / (w0 * h0 or 1):.0%}, mất {info['elapsed_ms']:.1f}ms"
+    )
+    return PreprocessedImage(base64.b64encode(processed).decode("ascii"), info["phash"], info["fingerprint"])
+
+
+def stats() -> dict:
+    images = _stats["images"]
+    return {
+        **{k: round(v, 1) if isinstance(v, float) else v for k, v in _stats.items()},
+        "avg_ms": round(_stats["total_ms"] / images, 1) if images else 0.0,
+        "bytes_saved_ratio": round(1 - _stats["bytes_out"] / _stats["bytes_in"], 3) if _stats["bytes_in"] else 0.0,
+    }
+
+
+metrics.register("image_preprocess", stats)
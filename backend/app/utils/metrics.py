@@ -0,0 +1,28 @@
+# app/utils/metrics.py
+from collections import defaultdict
+from typing import Callable, Dict
+
+
+class MetricsRegistry:
+    """Counter đơn giản + collector trả snapshot, export qua /api/metrics."""
+
+    def __init__(self):
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+
+    def inc(self, name: str, value: int = 1):
+        self._counters[name] += value
+
+    def register(self, name: str, collector: Callable[[], dict]):
+        """Đăng ký hàm trả số liệu hiện tại của một thành phần (gọi lúc export)."""
+        self._collectors[name] = collector
+
+    def snapshot(self) -> dict:
+        data = {"counters": dict(self._counters)}
+        for name, collector in self._collectors.items():
+            data[name] = collector()
+        return data
+
+
+# Khởi tạo singleton instance
+metrics = MetricsRegistry()
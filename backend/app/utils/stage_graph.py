@@ -0,0 +1,61 @@
+# app/utils/stage_graph.py
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+
+from app.utils.logger import logger
+
+
+class StageGraph:
+    """Đồ thị phụ thuộc giữa các stage async.
+
+    Mỗi stage chạy ngay khi mọi dependency của nó hoàn tất; kết quả của
+    dependency được truyền vào hàm stage dưới dạng keyword argument cùng tên.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Tuple[Callable[..., Awaitable[Any]], Tuple[str, ...]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def add(self, name: str, fn: Callable[..., Awaitable[Any]], deps: Iterable[str] = ()) -> "StageGraph":
+        """Đăng ký stage `name`, chỉ được gọi trước start()."""
+        if self._tasks:
+            raise RuntimeError("Không thể thêm stage sau khi graph đã chạy")
+        if name in self._stages:
+            raise ValueError(f"Stage {name} đã tồn tại")
+        deps = tuple(deps)
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage {name} phụ thuộc stage chưa đăng ký: {dep}")
+        self._stages[name] = (fn, deps)
+        return self
+
+    def start(self) -> "StageGraph":
+        """Tạo task cho mọi stage; các stage độc lập chạy đồng thời."""
+        # Thứ tự đăng ký đã là thứ tự topo vì dependency phải đăng ký trước
+        for name, (fn, deps) in self._stages.items():
+            self._tasks[name] = asyncio.create_task(self._run(name, fn, deps), name=f"stage:{name}")
+        return self
+
+    async def _run(self, name: str, fn: Callable[..., Awaitable[Any]], deps: Tuple[str, ...]) -> Any:
+        kwargs = {dep: await self._tasks[dep] for dep in deps}
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await fn(**kwargs)
+        logger.debug(f"Stage {name} hoàn tất sau {(loop.time() - started) * 1000:.0f}ms")
+        return result
+
+    async def result(self, name: str) -> Any:
+        """Chờ và trả kết quả của stage `name` (raise lại exception nếu stage lỗi)."""
+        return await asyncio.shield(self._tasks[name])
+
+    def done(self, name: str) -> bool:
+        return name in self._tasks and self._tasks[name].done()
+
+    async def cancel(self) -> int:
+        """Hủy mọi stage còn đang chạy, chờ chúng kết thúc; trả số stage bị hủy."""
+        pending = [task for task in self._tasks.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        # Thu kết quả để không còn cảnh báo "exception was never retrieved"
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        return len(pending)
@@ -0,0 +1,68 @@
+# benchmarks/bench_embed_batch.py
+"""So sánh embed từng text tuần tự với embed đồng thời qua embedding_batcher trên Ollama thật.
+
+Chạy từ thư mục backend:
+    python -m benchmarks.bench_embed_batch --texts 32 --rounds 3
+
+"serial" gọi /api/embed cho từng text trong vòng lặp (như rerank cũ của search_web);
+"batched" gọi embed_text đồng thời bằng asyncio.gather để batcher gom thành ít request.
+Cache embedding bị tắt và mỗi vòng dùng text mới để không đo nhầm cache hit.
+"""
+import argparse
+import asyncio
+import time
+
+from app.config import settings
+from app.services.embedding_batcher import embedding_batcher
+from app.services.embedding_cache import embedding_cache
+from app.services.ollama_client import OllamaClient
+from app.utils.embed import embed_text
+
+PASSAGE = (
+    "FastAPI trả NDJSON bằng StreamingResponse; mỗi dòng là một JSON độc lập để client đọc dần. "
+    "Ollama nhận input dạng list ở /api/embed và trả embedding cho cả batch trong một lần gọi. "
+)
+
+
+def make_texts(n: int, round_index: int):
+    return [f"{PASSAGE} (trang {round_index}-{i})" for i in range(n)]
+
+
+async def serial(texts):
+    for text in texts:
+        await OllamaClient.post("/api/embed", {"model": settings.EMBEDDING_MODEL, "input": [text]})
+
+
+async def batched(texts):
+    await asyncio.gather(*(embed_text(text) for text in texts))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--texts", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    embedding_cache.path = ""
+    embedding_cache.max_entries = 0
+    await OllamaClient.start()
+    try:
+        await embed_text("warm-up")  # Load model trước khi đo
+        print(f"{'mode':>8} {'round':>5} {'total ms':>9} {'ms/text':>8} {'text/s':>8}")
+        for mode, run in (("serial", serial), ("batched", batched)):
+            for round_index in range(args.rounds):
+                texts = make_texts(args.texts, round_index if mode == "serial" else args.rounds + round_index)
+                started = time.perf_counter()
+                await run(texts)
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{mode:>8} {round_index + 1:>5} {elapsed * 1000:>9.1f} "
+                    f"{elapsed * 1000 / len(texts):>8.2f} {len(texts) / elapsed:>8.1f}"
+                )
+        print(f"\nbatcher: {embedding_batcher.stats()}")
+    finally:
+        await OllamaClient.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
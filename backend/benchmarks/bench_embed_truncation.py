@@ -0,0 +1,79 @@
+# benchmarks/bench_embed_truncation.py
+"""Đo recall@k / độ trễ / dung lượng khi cắt Matryoshka embedding trên dữ liệu hội thoại thật.
+
+Chạy từ thư mục backend (không cần Ollama, đọc vector đã lưu trong MEMORY_DIR):
+    python -m benchmarks.bench_embed_truncation --dims 512 256 128 --k 5
+
+Vector lấy từ mọi conversation trong thư mục memory (snapshot + WAL). Mỗi query là một memory có sẵn,
+kết quả đúng là top-k theo vector đầy đủ (bỏ chính nó); recall là tỉ lệ top-k sau khi cắt còn d chiều
+và chuẩn hóa lại trùng với kết quả đó. Memory đã lưu ở số chiều nhỏ hơn chỉ so được với các d nhỏ hơn.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from app.config import settings
+from app.services.memory_store import MemoryStore, l2_normalize
+
+
+def load_vectors(directory: Path) -> np.ndarray:
+    groups = {}
+    for conversation in sorted(p for p in directory.iterdir() if p.is_dir()):
+        vectors = MemoryStore(conversation, settings.MEMORY_DIM).read_vectors()
+        if len(vectors):
+            groups.setdefault(vectors.shape[1], []).append(vectors)
+    if not groups:
+        return np.empty((0, 0), dtype="float32")
+    # Dùng nhóm số chiều lớn nhất (các conversation khác số chiều không trộn được)
+    dim = max(groups)
+    return np.concatenate(groups[dim])
+
+
+def search(vectors: np.ndarray, queries: np.ndarray, k: int):
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    started = time.perf_counter()
+    _, ids = index.search(queries, k + 1)
+    per_query = (time.perf_counter() - started) * 1000 / len(queries)
+    return ids, per_query
+
+
+def drop_self(ids: np.ndarray, picks: np.ndarray, k: int) -> np.ndarray:
+    return np.array([[i for i in row if i != pick][:k] for row, pick in zip(ids, picks)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=settings.MEMORY_DIR)
+    parser.add_argument("--dims", type=int, nargs="+", default=[512, 256, 128])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    vectors = load_vectors(Path(args.dir)) if Path(args.dir).exists() else np.empty((0, 0), dtype="float32")
+    if len(vectors) <= args.k:
+        print(f"Không đủ vector memory trong {args.dir} (cần > {args.k}), hãy chat vài lượt rồi chạy lại")
+        return
+    vectors = l2_normalize(vectors)
+    full_dim = vectors.shape[1]
+    rng = np.random.default_rng(0)
+    picks = rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)
+
+    truth_ids, full_ms = search(vectors, vectors[picks], args.k)
+    truth = drop_self(truth_ids, picks, args.k)
+    print(f"{len(vectors)} vector {full_dim} chiều, {len(picks)} query, k={args.k}\n")
+    print(f"{'dim':>5} {'recall@k':>9} {'ms/query':>9} {'MB/1e5 vec':>11}")
+    print(f"{full_dim:>5} {1:>9.3f} {full_ms:>9.3f} {full_dim * 4 * 1e5 / 2**20:>11.1f}")
+    for dim in sorted((d for d in args.dims if d < full_dim), reverse=True):
+        truncated = l2_normalize(vectors[:, :dim])
+        ids, ms = search(truncated, truncated[picks], args.k)
+        found = drop_self(ids, picks, args.k)
+        recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+        print(f"{dim:>5} {recall:>9.3f} {ms:>9.3f} {dim * 4 * 1e5 / 2**20:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
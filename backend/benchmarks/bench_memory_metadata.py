@@ -0,0 +1,96 @@
+# benchmarks/bench_memory_metadata.py
+"""Đo bộ nhớ metadata mỗi memory entry: list dict (cũ) so với MemoryColumns (trong RAM / content trên đĩa).
+
+Chạy từ thư mục backend (không cần Ollama):
+    python -m benchmarks.bench_memory_metadata --entries 100000
+
+Bộ nhớ đo bằng tracemalloc (mọi allocation Python + NumPy) khi dựng N entry có nội dung
+giống message chat thật (độ dài ngẫu nhiên, tiếng Việt có dấu). Kèm thời gian mở lại từ đĩa.
+"""
+import argparse
+import gc
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from app.services.memory_columns import MemoryColumns
+
+WORDS = "hệ thống memory FAISS truy xuất ngữ cảnh câu hỏi người dùng trả lời mô hình embedding vector tìm kiếm".split()
+
+
+def make_messages(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1)
+    for i in range(n):
+        length = rng.randint(5, 120)
+        yield (
+            "user" if i % 2 == 0 else "assistant",
+            " ".join(rng.choice(WORDS) for _ in range(length)),
+            start + timedelta(seconds=30 * i),
+        )
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    keep = build()
+    elapsed = time.perf_counter() - started
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return keep, used, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100_000)
+    args = parser.parse_args()
+    n = args.entries
+
+    def build_dicts():
+        return [{"role": role, "content": content, "time": when} for role, content, when in make_messages(n)]
+
+    def build_columns():
+        columns = MemoryColumns()
+        for role, content, when in make_messages(n):
+            columns.append(role, content, when)
+        return columns
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path, index_path = Path(tmp) / "store.jsonl", Path(tmp) / "store.idx.npz"
+
+        def build_on_disk():
+            columns = MemoryColumns(path)
+            for role, content, when in make_messages(n):
+                columns.append(role, content, when)
+            return columns
+
+        print(f"{'layout':>16} {'bytes/entry':>12} {'build s':>8}")
+        rows = [("list[dict]", build_dicts), ("columns (RAM)", build_columns), ("columns (disk)", build_on_disk)]
+        for name, build in rows:
+            keep, used, elapsed = measure(build)
+            print(f"{name:>16} {used / n:>12.1f} {elapsed:>8.2f}")
+            if name == "columns (disk)":
+                keep.save_index(index_path)
+            del keep
+
+        started = time.perf_counter()
+        MemoryColumns.open(path, Path(tmp) / "missing.npz")
+        full_scan = time.perf_counter() - started
+        started = time.perf_counter()
+        reopened, _ = MemoryColumns.open(path, index_path)
+        with_index = time.perf_counter() - started
+        print(f"\nMở lại {n} entry: parse JSONL {full_scan * 1000:.0f} ms, có store.idx.npz {with_index * 1000:.1f} ms")
+        started = time.perf_counter()
+        for i in range(0, n, max(1, n // 1000)):
+            reopened[i]
+        per_read = (time.perf_counter() - started) / len(range(0, n, max(1, n // 1000)))
+        print(f"Đọc một entry theo id từ đĩa: {per_read * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
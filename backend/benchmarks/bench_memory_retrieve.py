@@ -0,0 +1,83 @@
+# benchmarks/bench_memory_retrieve.py
+"""Đo độ trễ HybridMemory.search (vector + BM25 + RRF + trọng số thời gian) theo số memory.
+
+Chạy từ thư mục backend (không cần Ollama):
+    python -m benchmarks.bench_memory_retrieve --sizes 10000 100000 --dim 768
+
+Không tính thời gian embed query (gọi Ollama). Memory giả lập gồm message chat có nội dung ngẫu nhiên
+kèm định danh riêng (tên hàm, mã lỗi) để kênh BM25 có kết quả khớp chính xác; index vector đi đúng
+loại AdaptiveIndex chọn theo số vector (HNSW từ MEMORY_HNSW_THRESHOLD). Giống traffic thật, mỗi query
+chạy ngay sau khi thêm một memory mới (BM25 + FAISS), thời gian thêm được báo riêng.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app.services.memory_index import build_ann, configure_search, target_kind
+from app.services.memory_manager import HybridMemory
+from app.services.memory_store import l2_normalize
+from app.utils.bm25 import tokenize
+
+WORDS = "hệ thống memory FAISS truy xuất ngữ cảnh câu hỏi người dùng trả lời mô hình embedding vector tìm kiếm".split()
+
+
+def make_content(text_rng: random.Random, i: int) -> str:
+    return " ".join(text_rng.choice(WORDS) for _ in range(text_rng.randint(5, 60))) + f" handler_{i} E{i:06d}"
+
+
+def populate(memory: HybridMemory, n: int, dim: int, rng: np.random.Generator, text_rng: random.Random):
+    start = datetime.utcnow() - timedelta(days=30)
+    vectors = l2_normalize(rng.standard_normal((n, dim)).astype("float32"))
+    for i in range(n):
+        content = make_content(text_rng, i)
+        memory.store.append("user" if i % 2 == 0 else "assistant", content, start + timedelta(seconds=25 * i))
+        memory.lexical.add(tokenize(content))
+    memory.index.add(vectors)
+    kind = target_kind(n)
+    if kind != "flat":
+        memory.index.ann = build_ann(kind, vectors, memory.index.raw.metric_type)
+        configure_search(memory.index.ann)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{'n':>8} {'index':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'add ms':>7} {'exact hit':>10}")
+    for n in args.sizes:
+        memory = HybridMemory(dim=args.dim)
+        text_rng = random.Random(0)
+        vectors = populate(memory, n, args.dim, rng, text_rng)
+        picks = rng.integers(0, n, args.queries)
+        latencies = []
+        adds = []
+        found = 0
+        for step, i in enumerate(picks.tolist()):
+            # Memory mới của lượt chat vừa rồi (đi qua đường ghi thật: store + BM25 + FAISS)
+            started = time.perf_counter()
+            memory._add_long_term("user", make_content(text_rng, n + step), l2_normalize(rng.standard_normal(args.dim)))
+            adds.append((time.perf_counter() - started) * 1000)
+            # Query chứa định danh của memory i nhưng vector lệch (embedding không bắt được định danh)
+            qvec = l2_normalize(vectors[i] + rng.standard_normal(args.dim).astype("float32"))
+            started = time.perf_counter()
+            results = memory.search(f"lỗi E{i:06d} ở đâu", qvec, args.k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            found += any(f"E{i:06d}" in item["content"] for item in results)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(
+            f"{n:>8} {memory.index.kind:>6} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} "
+            f"{np.median(adds):>7.2f} {found / args.queries:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
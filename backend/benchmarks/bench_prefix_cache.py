@@ -0,0 +1,98 @@
+# benchmarks/bench_prefix_cache.py
+"""Đo thời gian prefill mỗi lượt của layout "legacy" và "stable" trên Ollama thật.
+
+Chạy từ thư mục backend:
+    python -m benchmarks.bench_prefix_cache --model 4T --turns 12
+
+Mỗi layout chạy cùng một hội thoại giả lập; thời gian prefill lấy từ
+`prompt_eval_duration` / `prompt_eval_count` trong response của /api/chat.
+Khi prefix khớp lượt trước, Ollama chỉ prefill phần mới nên hai số này giảm.
+"""
+import argparse
+import asyncio
+import time
+
+from app.services.context_builder import (
+    build_legacy_messages,
+    build_stable_messages,
+    stable_history_window,
+)
+from app.services.get_time import get_current_time_info
+from app.services.ollama_client import OllamaClient
+
+QUESTIONS = [
+    "Giải thích ngắn gọn asyncio event loop trong Python.",
+    "So sánh list và deque khi pop phần tử đầu.",
+    "FAISS IndexFlatL2 hoạt động thế nào?",
+    "Viết ví dụ FastAPI StreamingResponse trả NDJSON.",
+    "Làm sao giới hạn số request đồng thời tới một service?",
+    "KV cache trong LLM là gì?",
+]
+
+
+async def run_layout(layout: str, model: str, turns: int, max_messages: int, block: int, num_predict: int):
+    history = []
+    total_messages = 0
+    rows = []
+    for turn in range(turns):
+        question = f"{QUESTIONS[turn % len(QUESTIONS)]} (lượt {turn + 1})"
+        # Thời gian thay đổi mỗi lượt, mô phỏng get_current_time_info() đổi theo phút
+        time_string = f"{get_current_time_info()} [t+{turn}m]"
+        if layout == "stable":
+            window = stable_history_window(history, total_messages, max_messages, block)
+            relevant = [{"role": "user", "content": f"memory truy xuất cho lượt {turn}"}]
+            messages = build_stable_messages(question, window, time_string, relevant)
+        else:
+            relevant = [{"role": "user", "content": f"memory truy xuất cho lượt {turn}"}]
+            context = history[-max_messages:] + [{"role": "system", "content": f"Relevant memory: {relevant}"}]
+            messages = build_legacy_messages(question, context, time_string)
+
+        started = time.perf_counter()
+        data = await OllamaClient.post(
+            "/api/chat",
+            {"model": model, "messages": messages, "stream": False, "options": {"num_predict": num_predict}},
+        )
+        wall = time.perf_counter() - started
+        prefill_ms = data.get("prompt_eval_duration", 0) / 1e6
+        rows.append((turn + 1, data.get("prompt_eval_count", 0), prefill_ms, wall * 1000))
+
+        answer = data.get("message", {}).get("content", "")
+        history.extend([{"role": "user", "content": question}, {"role": "assistant", "content": answer}])
+        total_messages += 2
+        history = history[-20:]  # Giống HybridMemory.max_short
+    return rows
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="4T")
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--max-messages", type=int, default=10)
+    parser.add_argument("--block", type=int, default=6)
+    parser.add_argument("--num-predict", type=int, default=64)
+    args = parser.parse_args()
+
+    await OllamaClient.start()
+    try:
+        results = {}
+        for layout in ("legacy", "stable"):
+            results[layout] = await run_layout(
+                layout, args.model, args.turns, args.max_messages, args.block, args.num_predict
+            )
+
+        print(f"{'lượt':>4} | {'legacy tok':>10} {'legacy ms':>10} | {'stable tok':>10} {'stable ms':>10} | {'tiết kiệm ms':>12}")
+        saved_total = 0.0
+        for legacy, stable in zip(results["legacy"], results["stable"]):
+            saved = legacy[2] - stable[2]
+            saved_total += saved
+            print(f"{legacy[0]:>4} | {legacy[1]:>10} {legacy[2]:>10.1f} | {stable[1]:>10} {stable[2]:>10.1f} | {saved:>12.1f}")
+        # Bỏ lượt đầu (cả hai đều prefill từ đầu)
+        warm_turns = max(1, args.turns - 1)
+        first_saved = results["legacy"][0][2] - results["stable"][0][2]
+        print(f"Prefill tiết kiệm trung bình mỗi lượt (từ lượt 2): {(saved_total - first_saved) / warm_turns:.1f} ms")
+    finally:
+        await OllamaClient.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
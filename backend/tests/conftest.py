@@ -0,0 +1,6 @@
+# tests/conftest.py
+import sys
+from pathlib import Path
+
+# Cho phép `import app...` khi chạy pytest từ thư mục gốc repo hoặc backend
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,13 @@
+# tests/test_chat_openapi.py
+from app.main import app
+
+
+def test_chat_body_is_documented_for_json_and_multipart():
+    operation = app.openapi()["paths"]["/api/chat"]["post"]
+    content = operation["requestBody"]["content"]
+
+    assert content["application/json"]["schema"]["title"] == "ChatRequest"
+    assert content["application/json"]["schema"]["required"] == ["prompt"]
+    form = content["multipart/form-data"]["schema"]["properties"]
+    assert set(form) == {"prompt", "conversation_id", "is_thinking", "image"}
+    assert form["image"]["format"] == "binary"
@@ -0,0 +1,37 @@
+# tests/test_context_packing.py
+import asyncio
+
+import numpy as np
+
+from app.routes import chat
+from app.services.context_builder import messages_tokens, pack_context
+
+
+def test_overflowing_reranked_history_keeps_most_relevant(monkeypatch):
+    prompt_vec = np.eye(8, dtype="float32")[0]
+    # Độ liên quan với prompt: message 5 (assistant) cao nhất, rồi 3 (assistant), 6 (assistant)
+    relevance = [0.0, 0.1, 0.0, 0.8, 0.0, 0.9, 0.7, 0.0]
+    messages, vectors = [], []
+    for i, score in enumerate(relevance):
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": f"message số {i} " + "nội dung " * 20})
+        vec = np.zeros(8, dtype="float32")
+        vec[0], vec[1 + i % 7] = score, 1.0
+        vectors.append(vec)
+    pinned = {"role": "system", "content": "Relevant memory:\n- [user] ghi chú cũ"}
+
+    async def fake_embed(_text):
+        return prompt_vec
+
+    monkeypatch.setattr(chat, "embed_text", fake_embed)
+    reranked = asyncio.run(chat.rerank_messages(messages + [pinned], "câu hỏi", 3, vectors + [None]))
+    assert [m["content"].split()[2] for m in reranked[:3]] == ["3", "5", "6"]  # Theo thứ tự thời gian
+    assert reranked[-1] is pinned
+
+    # Ngân sách chỉ đủ cho 2 trong 3 message đã chọn + memory ghim: bỏ message cũ nhất, không làm rỗng history
+    budget = messages_tokens(reranked[1:])
+    packed = pack_context(
+        reranked, [], fixed_tokens=0, num_ctx=budget, response_reserve=0,
+        memory_tokens=0, max_reply_tokens=10_000, align_turns=False,
+    )
+    assert [m["content"].split()[2] for m in packed.history[:2]] == ["5", "6"]
+    assert packed.history[-1] is pinned
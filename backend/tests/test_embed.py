@@ -0,0 +1,31 @@
+# tests/test_embed.py
+import asyncio
+
+from app.services import embedding_batcher as batcher_module
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.services.embedding_cache import EmbeddingCache
+from app.utils import embed
+
+
+def test_embed_texts_goes_through_batcher(monkeypatch):
+    requests = []
+
+    async def fake_post(path, payload, **kwargs):
+        requests.append(len(payload["input"]))
+        return {"embeddings": [[float(len(text)), 1.0] for text in payload["input"]]}
+
+    batcher = EmbeddingBatcher(window_ms=5, max_batch=4)
+    monkeypatch.setattr(batcher_module.OllamaClient, "post", fake_post)
+    monkeypatch.setattr(embed, "embedding_batcher", batcher)
+    monkeypatch.setattr(embed, "embedding_cache", EmbeddingCache(max_entries=64))
+    monkeypatch.setattr(embed.settings, "EMBED_TRUNCATE_DIM", 0)
+
+    texts = [f"message {i}" * (i + 1) for i in range(10)]
+    vectors = asyncio.run(embed.embed_texts(texts))
+
+    assert [v[0] for v in vectors] == [float(len(t)) for t in texts]
+    assert requests == [4, 4, 2]  # Giới hạn kích thước batch của embedding_batcher
+    assert batcher.stats()["items"] == 10
+    # Lần sau lấy từ cache, không gọi /api/embed
+    asyncio.run(embed.embed_texts(texts[:3]))
+    assert len(requests) == 3
@@ -0,0 +1,34 @@
+# tests/test_embedding_cache.py
+import asyncio
+
+import numpy as np
+
+from app.services.embedding_cache import EmbeddingCache, embedding_key
+
+
+def test_disk_tier_survives_restart_and_tracks_row_count(tmp_path):
+    path = str(tmp_path / "embed.sqlite3")
+    vector = np.random.default_rng(0).standard_normal(16).astype("float32")
+    keys = [embedding_key("m", f"text {i}") for i in range(30)]
+
+    async def write():
+        cache = EmbeddingCache(max_entries=4, path=path, disk_max_entries=20)
+        for key in keys:
+            cache.put(key, vector)
+        await cache.close()
+        # Vượt giới hạn: xóa tới dưới giới hạn 10% mà không COUNT lại
+        assert cache.stats()["disk_entries"] == 18
+
+    async def read():
+        cache = EmbeddingCache(max_entries=4, path=path, disk_max_entries=20)
+        found = await cache.get_many(keys)
+        assert sum(v is not None for v in found) == 18
+        last = max(i for i, v in enumerate(found) if v is not None)
+        assert np.abs(found[last] - vector).max() < 1e-2
+        assert await cache.get(keys[last]) is not None  # Lần hai hit trong RAM
+        stats = cache.stats()
+        assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (1, 18, 12)
+        await cache.close()
+
+    asyncio.run(write())
+    asyncio.run(read())
@@ -0,0 +1,37 @@
+# tests/test_image_preprocess.py
+import asyncio
+import base64
+import io
+
+from PIL import Image
+
+from app.utils import image_preprocess
+from app.utils.image_preprocess import preprocess_image
+
+
+def jpeg_with_gps() -> bytes:
+    exif = Image.Exif()
+    exif[0x010F] = "PhoneMaker"  # Make
+    exif[0x8825] = {2: (21.0, 1.0, 0.0), 4: (105.0, 50.0, 0.0)}  # GPSInfo: vĩ độ / kinh độ
+    out = io.BytesIO()
+    Image.new("RGB", (64, 48), "red").save(out, "JPEG", exif=exif)
+    return out.getvalue()
+
+
+def test_failed_preprocess_never_forwards_metadata(monkeypatch):
+    def broken(_image_bytes):
+        raise ValueError("EXIF hỏng")
+
+    monkeypatch.setattr(image_preprocess, "_preprocess", broken)
+    original = jpeg_with_gps()
+    processed = asyncio.run(preprocess_image(original))
+
+    sent = base64.b64decode(processed.base64)
+    assert sent != original
+    with Image.open(io.BytesIO(sent)) as img:
+        assert img.size == (64, 48)
+        assert not img.getexif()
+
+
+def test_undecodable_image_is_rejected():
+    assert asyncio.run(preprocess_image(b"not an image")) is None
@@ -0,0 +1,12 @@
+# tests/test_llm_router.py
+from app.services.llm_router import is_context_free
+
+
+def test_context_free_prompts_are_shared_across_conversations():
+    for prompt in ["Xin chào", "hello", "Docker là gì?", "giải thích thuật toán Dijkstra"]:
+        assert is_context_free(prompt), prompt
+
+
+def test_prompts_referencing_history_are_not_context_free():
+    for prompt in ["giải thích thêm về nó", "tiếp tục đi", "tên tôi là gì?", "what did I say earlier", "đoạn code trên sai ở đâu"]:
+        assert not is_context_free(prompt), prompt
@@ -0,0 +1,65 @@
+# tests/test_memory_manager.py
+import asyncio
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from app.services.memory_manager import HybridMemory
+from app.services.memory_store import MemoryStore, l2_normalize
+
+
+def test_pending_writes_covers_snapshot(tmp_path):
+    async def scenario():
+        memory = HybridMemory(dim=8, persistence=MemoryStore(tmp_path, 8), snapshot_every=1)
+        seen = []
+        snapshot = memory.index.snapshot
+
+        def recording_snapshot():
+            seen.append(memory.pending_writes)
+            return snapshot()
+
+        memory.index.snapshot = recording_snapshot
+        entry = {"role": "user", "content": "đã rời short-term"}
+        memory._pending.add(0)
+        await memory.apply_vectors([(0, entry, l2_normalize(np.ones(8, dtype="float32")))])
+
+        # Trong lúc ghi snapshot memory vẫn bận (registry không được evict), xong thì về 0
+        assert seen and all(seen)
+        assert memory.pending_writes == 0
+        assert memory.index.ntotal == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_batch_releases_every_pending_message():
+    async def scenario():
+        memory = HybridMemory(dim=8, max_short=1)
+        vec = l2_normalize(np.ones(8, dtype="float32"))
+        await memory.add_message("user", "câu hỏi", vec)
+
+        def broken(*args):
+            raise RuntimeError("lỗi ghi FAISS")
+
+        memory._add_long_term = broken
+        # Message mới + message cũ bị đẩy ra (spill) cùng một batch, spill lỗi giữa chừng
+        with pytest.raises(RuntimeError):
+            await memory.add_message("assistant", "trả lời", vec)
+        assert memory.pending_writes == 0
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_merges_past_a_closer_summary():
+    memory = HybridMemory(dim=8, duplicate_similarity=0.97)
+    base = l2_normalize(np.arange(1, 9, dtype="float32"))
+    repeat = l2_normalize(base + 0.01)
+    memory._add_long_term("user", "cảm ơn nhé", base)
+    # Summary còn gần message lặp lại hơn cả message gốc: đứng đầu kết quả search
+    memory.store.append("summary", "tóm tắt: user cảm ơn", datetime.utcnow(), level=1, span=(0, 1))
+    memory.index.add(np.expand_dims(repeat, 0))
+    hits = int(memory.store.hits[0])
+
+    memory._add_long_term("user", "cảm ơn nhé!", repeat)
+    assert len(memory.store) == 2
+    assert memory.store.hits[0] == hits + 1
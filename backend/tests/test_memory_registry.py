@@ -0,0 +1,59 @@
+# tests/test_memory_registry.py
+import asyncio
+import os
+import threading
+import time
+
+from app.services.memory_registry import MemoryRegistry
+
+
+def test_enforce_limits_skips_memory_with_running_upgrade():
+    async def scenario():
+        registry = MemoryRegistry(dim=8, max_conversations=1)
+        first = await registry.get("a")
+        training = asyncio.get_running_loop().create_future()
+        first.index._task = training  # Giả lập train index ANN nền còn đang chạy
+
+        await registry.get("b")
+        assert registry.stats()["conversations"] == 2
+
+        # Train xong: lượt sau evict được
+        training.set_result(None)
+        registry.enforce_limits()
+        assert registry.stats()["conversations"] == 1
+        assert await registry.get("b") is not first
+
+    asyncio.run(scenario())
+
+
+def test_cleanup_removes_only_stale_unloaded_conversations(tmp_path):
+    registry = MemoryRegistry(dim=8, directory=str(tmp_path), retention_days=30)
+    stale = time.time() - 31 * 86400
+    for name in ("old", "recent", "open"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "history.jsonl").write_text("{}\n")
+    for name in ("old", "open"):
+        os.utime(tmp_path / name / "history.jsonl", (stale, stale))
+    registry._memories["open"] = object()  # Conversation đang mở trong RAM
+
+    assert registry.cleanup() == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["open", "recent"]
+
+
+def test_concurrent_get_opens_memory_once_off_the_event_loop(tmp_path):
+    registry = MemoryRegistry(dim=8, directory=str(tmp_path))
+    opened_in = []
+    create = registry._create
+
+    def recording_create(conversation_id):
+        opened_in.append(threading.current_thread())
+        return create(conversation_id)
+
+    registry._create = recording_create
+
+    async def scenario():
+        first, second = await asyncio.gather(registry.get("a"), registry.get("a"))
+        assert first is second
+
+    asyncio.run(scenario())
+    assert len(opened_in) == 1 and opened_in[0] is not threading.main_thread()
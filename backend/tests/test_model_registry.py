@@ -0,0 +1,47 @@
+# tests/test_model_registry.py
+import asyncio
+
+import httpx
+
+from app.services import model_registry as registry_module
+from app.services.model_registry import ModelRegistry
+
+
+def not_found(model: str) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://ollama/api/chat")
+    return httpx.HTTPStatusError(f"{model} not found", request=request, response=httpx.Response(404, request=request))
+
+
+def test_post_retries_fallback_after_stale_404(monkeypatch):
+    registry = ModelRegistry(fallbacks={"4T-R": ["4T"]}, refresh_seconds=60)
+    registry._available = {"4T-R:latest", "4T:latest"}  # /api/tags cũ: 4T-R đã bị xóa sau lần refresh
+    sent = []
+
+    async def fake_post(path, payload, **kwargs):
+        sent.append(payload["model"])
+        if payload["model"] == "4T-R":
+            raise not_found("4T-R")
+        return {"message": {"content": "ok"}}
+
+    monkeypatch.setattr(registry_module.OllamaClient, "post", fake_post)
+    data = asyncio.run(registry.post("/api/chat", {"model": registry.resolve("4T-R")}, requested="4T-R"))
+
+    assert data["message"]["content"] == "ok"
+    assert sent == ["4T-R", "4T"]
+    assert registry.resolve("4T-R") == "4T"  # Lượt sau chọn fallback ngay
+
+
+def test_post_raises_when_no_fallback_left(monkeypatch):
+    registry = ModelRegistry(fallbacks={}, refresh_seconds=60)
+
+    async def fake_post(path, payload, **kwargs):
+        raise not_found(payload["model"])
+
+    monkeypatch.setattr(registry_module.OllamaClient, "post", fake_post)
+    try:
+        asyncio.run(registry.post("/api/chat", {"model": "4T-V"}))
+    except httpx.HTTPStatusError as e:
+        assert e.response.status_code == 404
+    else:
+        raise AssertionError("404 phải được raise khi không còn fallback")
+    assert not registry.is_available("4T-V")
@@ -0,0 +1,54 @@
+# tests/test_ollama_scheduler.py
+import asyncio
+
+from app.services.ollama_scheduler import OllamaScheduler, Priority
+
+
+def make_scheduler() -> OllamaScheduler:
+    return OllamaScheduler(
+        max_concurrency=4,
+        class_limits={Priority.INTERACTIVE: 2, Priority.EMBEDDING: 4, Priority.BACKGROUND: 1},
+        max_queue={p: 8 for p in Priority},
+        max_wait={p: 0.2 for p in Priority},
+    )
+
+
+def test_lower_class_admitted_while_higher_waiter_blocked_by_class_limit():
+    async def scenario():
+        scheduler = make_scheduler()
+        await scheduler.acquire(Priority.INTERACTIVE)
+        await scheduler.acquire(Priority.INTERACTIVE)
+        queued = asyncio.create_task(scheduler.acquire(Priority.INTERACTIVE))
+        await asyncio.sleep(0)
+        assert len(scheduler._queues[Priority.INTERACTIVE]) == 1
+
+        # INTERACTIVE đã đủ giới hạn lớp, còn 2/4 slot toàn cục: lớp thấp hơn không phải chờ
+        await asyncio.wait_for(scheduler.acquire(Priority.EMBEDDING), timeout=0.05)
+        await asyncio.wait_for(scheduler.acquire(Priority.BACKGROUND), timeout=0.05)
+        assert scheduler.total_active == 4
+
+        # Slot INTERACTIVE trả lại thuộc về waiter INTERACTIVE đang chờ
+        scheduler.release(Priority.INTERACTIVE)
+        await asyncio.wait_for(queued, timeout=0.05)
+        assert scheduler._active[Priority.INTERACTIVE] == 2
+
+    asyncio.run(scenario())
+
+
+def test_lower_class_waits_for_admissible_higher_waiter():
+    async def scenario():
+        scheduler = make_scheduler()
+        for _ in range(4):
+            await scheduler.acquire(Priority.EMBEDDING)
+        interactive = asyncio.create_task(scheduler.acquire(Priority.INTERACTIVE))
+        background = asyncio.create_task(scheduler.acquire(Priority.BACKGROUND))
+        await asyncio.sleep(0)
+
+        # Một slot trống: INTERACTIVE (lấy được slot) đi trước BACKGROUND
+        scheduler.release(Priority.EMBEDDING)
+        await asyncio.wait_for(interactive, timeout=0.05)
+        assert not background.done()
+        scheduler.release(Priority.EMBEDDING)
+        await asyncio.wait_for(background, timeout=0.05)
+
+    asyncio.run(scenario())
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 import markdown
 import json
+import uuid
+from pathlib import Path
 from typing import Optional
 from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QTextCursor
@@ -9,10 +11,35 @@ from PySide6.QtWidgets import QTextEdit
 from worker import OllamaWorker
 from screenshot_capture import ScreenshotOverlay
 
+# Lưu conversation_id để mở lại app vẫn dùng memory cũ trên backend
+CONVERSATION_FILE = Path.home() / ".4t_assistant" / "conversation_id"
+
+
+def new_conversation_id() -> str:
+    """Tạo conversation_id mới và lưu lại cho các lần mở app sau."""
+    conversation_id = uuid.uuid4().hex
+    try:
+        CONVERSATION_FILE.parent.mkdir(parents=True, exist_ok=True)
+        CONVERSATION_FILE.write_text(conversation_id, encoding="utf-8")
+    except OSError as e:
+        print(f"Không lưu được conversation_id: {e}")
+    return conversation_id
+
+
+def load_conversation_id() -> str:
+    """conversation_id đã lưu, chưa có (hoặc đọc lỗi) thì tạo mới."""
+    try:
+        conversation_id = CONVERSATION_FILE.read_text(encoding="utf-8").strip()
+    except OSError:
+        conversation_id = ""
+    return conversation_id or new_conversation_id()
+
+
 class ChatLogic:
     def __init__(self, parent):
         self.parent = parent
         self.ollama_thread: Optional[OllamaWorker] = None
+        self.conversation_id = load_conversation_id()  # Memory riêng của client này trên backend
         self.chunk_buffer = ""
         self.thinking_buffer = ""
         self.full_thinking_md = ""
@@ -21,6 +48,17 @@ class ChatLogic:
         self.buffer_timer.timeout.connect(self._flush_buffer)
         self.parent.user_scrolling = False
 
+    def new_conversation(self) -> None:
+        """Bắt đầu cuộc trò chuyện mới: backend dùng memory trống, memory cũ bị dọn theo MEMORY_RETENTION_DAYS."""
+        self.stop_worker()
+        self.conversation_id = new_conversation_id()
+        self.parent.full_response_md = ""
+        self.full_thinking_md = ""
+        self.parent.ui.response_display.clear()
+        self.parent.ui.thinking_display.clear()
+        self.parent.ui.thinking_widget.hide()
+        print(f"Bắt đầu conversation mới: {self.conversation_id}")
+
     def setup_connections(self) -> None:
         self.parent.ui.send_stop_button.send_clicked.connect(self.send_prompt)
         self.parent.ui.send_stop_button.stop_clicked.connect(self.stop_worker)
@@ -59,7 +97,7 @@ class ChatLogic:
         self.parent.ui.send_stop_button.set_running(True)
 
 
-        image_base64 = self.parent.current_screenshot_base64
+        image_bytes = self.parent.current_screenshot_png
 
         if self.ollama_thread:
             if self.ollama_thread.isRunning():
@@ -69,7 +107,7 @@ class ChatLogic:
             self.ollama_thread.deleteLater()
             self.ollama_thread = None
 
-        self.ollama_thread = OllamaWorker(prompt_text, image_base64=image_base64, is_thinking=True)
+        self.ollama_thread = OllamaWorker(prompt_text, image_bytes=image_bytes, is_thinking=True, conversation_id=self.conversation_id)
         self.ollama_thread.chunk_received.connect(self._buffer_chunk)
         self.ollama_thread.thinking_received.connect(self._buffer_thinking)
         self.ollama_thread.search_started.connect(self.on_search_started)
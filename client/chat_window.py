@@ -26,7 +26,7 @@ class ChatWindow(QWidget):
         self.user_scrolling = False
         self.last_scroll_value = 0
         self.sources_data = []
-        self.current_screenshot_base64 = None
+        self.current_screenshot_png = None
         self.tray_manager = None  # Thêm attribute để access tray
 
         self.ui = UIComponents(self)
@@ -114,7 +114,7 @@ class ChatWindow(QWidget):
     def apply_stylesheet(self):
         self.ui.apply_stylesheet()
 
-    def pixmap_to_base64(self, pixmap):
+    def pixmap_to_png_bytes(self, pixmap):
         scaled_pixmap = pixmap.scaled(40, 40, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.ui.icon_label.setPixmap(scaled_pixmap)
         self.ui.name_label.setText("Screenshot.png")
@@ -126,7 +126,7 @@ class ChatWindow(QWidget):
         buffer = QBuffer(byte_array)
         buffer.open(QIODevice.WriteOnly)
         pixmap.save(buffer, "PNG")
-        return byte_array.toBase64().data().decode()
+        return byte_array.data()  # Gửi thẳng bytes qua multipart, không encode base64
 
     def show_screenshot_preview(self, pixmap):
-        self.current_screenshot_base64 = self.pixmap_to_base64(pixmap)
+        self.current_screenshot_png = self.pixmap_to_png_bytes(pixmap)
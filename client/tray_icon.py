@@ -28,12 +28,15 @@ class TrayIconManager:
 
         menu = QMenu()
         show_action = QAction("Hỏi 4T", self.app)
+        new_conversation_action = QAction("Cuộc trò chuyện mới", self.app)
         quit_action = QAction("Thoát", self.app)
 
         show_action.triggered.connect(self.chat_window.center_and_show)
+        new_conversation_action.triggered.connect(self.chat_window.chat_logic.new_conversation)
         quit_action.triggered.connect(self.app.quit)
 
         menu.addAction(show_action)
+        menu.addAction(new_conversation_action)
         menu.addAction(quit_action)
         self.tray_icon.setContextMenu(menu)
         self.tray_icon.show()
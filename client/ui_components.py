@@ -364,7 +364,7 @@ class UIComponents:
 
     def delete_screenshot(self):
         self.preview_widget.hide()
-        self.parent.current_screenshot_base64 = None
+        self.parent.current_screenshot_png = None
         self.icon_label.clear()
         self.parent.adjust_window_height()
 
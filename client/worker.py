@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 from asyncio.log import logger
 import json
-import base64
 import gc
 from PySide6.QtCore import QThread, Signal
 import aiohttp
@@ -20,10 +19,11 @@ class OllamaWorker(QThread):
     error_received = Signal(str)
     finished = Signal()
 
-    def __init__(self, prompt: str, image_base64: str = None, is_thinking: bool = False):
+    def __init__(self, prompt: str, image_bytes: bytes = None, is_thinking: bool = False, conversation_id: str = "default"):
         super().__init__()
         self.prompt = prompt
-        self.image_base64 = image_base64
+        self.conversation_id = conversation_id
+        self.image_bytes = image_bytes
         self.is_thinking = is_thinking
         self.base_url = "http://localhost:8000"
         self.max_image_size = 20 * 1024 * 1024  # 20MB giới hạn
@@ -52,34 +52,27 @@ class OllamaWorker(QThread):
 
     async def _stream_response(self):
         try:
-            cleaned_image_base64 = None
-            if self.image_base64:
-                try:
-                    cleaned_image_base64 = self.image_base64
-                    if cleaned_image_base64.startswith('data:image'):
-                        cleaned_image_base64 = cleaned_image_base64.split(',')[1]
-                    image_size = len(base64.b64decode(cleaned_image_base64))
-                    if image_size > self.max_image_size:
-                        self.error_received.emit("Hình ảnh quá lớn, vượt quá giới hạn 20MB")
-                        print("Image size exceeds 20MB limit")
-                        return
-                except base64.binascii.Error:
-                    self.error_received.emit("Lỗi: Chuỗi base64 không hợp lệ")
-                    print("Invalid base64 string")
-                    return
+            if self.image_bytes and len(self.image_bytes) > self.max_image_size:
+                self.error_received.emit("Hình ảnh quá lớn, vượt quá giới hạn 20MB")
+                print("Image size exceeds 20MB limit")
+                return
 
             async with aiohttp.ClientSession() as session:
-                payload = {
-                    "prompt": self.prompt
-                }
-                if cleaned_image_base64:
-                    payload["image"] = cleaned_image_base64
-                logger.debug(f"Gửi payload: {json.dumps(payload, ensure_ascii=False)[:100]}...")
+                # multipart/form-data: ảnh gửi dạng bytes, không tốn 33% base64
+                form = aiohttp.FormData()
+                form.add_field("prompt", self.prompt)
+                form.add_field("conversation_id", self.conversation_id)
+                if self.image_bytes:
+                    form.add_field("image", self.image_bytes, filename="screenshot.png", content_type="image/png")
+                logger.debug(f"Gửi prompt: {self.prompt[:100]}... (ảnh: {len(self.image_bytes or b'')} bytes)")
 
                 async with session.post(
                     f"{self.base_url}/api/chat",
-                    json=payload
+                    data=form
                 ) as response:
+                    if response.status == 413:
+                        self.error_received.emit("Hình ảnh quá lớn, vượt quá giới hạn 20MB")
+                        return
                     if response.status != 200:
                         self.error_received.emit(f"Lỗi HTTP: {response.status}")
                         print(f"HTTP error: {response.status}")